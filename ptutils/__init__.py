@@ -5,6 +5,7 @@ from . import error
 from . import model
 from . import utils
 from . import runner
+from . import snapshot
 from . import database
 from . import optimizer
 from . import dataloader
@@ -15,6 +16,7 @@ __all__ = [base,
            error,
            model,
            runner,
+           snapshot,
            optimizer,
            database,
            dataloader]
@@ -1,11 +1,25 @@
+import os
+import re
 import bson
-import copy
+import json
+import mmap
 import time
+import zlib
+import errno
+import struct
+import sqlite3
+import tempfile
 import gridfs
+import atexit
 import hashlib
+import logging
+import itertools
+import weakref
 import datetime
 import threading
 import collections
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import pymongo as pm
 import cPickle as pickle
@@ -17,10 +31,165 @@ import torch
 import jsonpickle
 import jsonpickle.ext.numpy as jsonpickle_numpy
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 from .base import Base
+from .error import LoadError, ParamError
+from .snapshot import Snapshot, SnapshotBuffers
 
 jsonpickle_numpy.register_handlers()
 
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel('DEBUG')
+
+# Key of the sub-document holding a jsonpickled value (see `_mongoify`).
+JSONPICKLE_TAG = '_jsonpickle'
+# Untagged jsonpickle strings of older records start with this.
+_LEGACY_JSONPICKLE_PREFIX = '{"py/'
+# Values Mongo cannot store, which `_mongoify` jsonpickles.
+_JSONPICKLED_TYPES = (type, collections.Callable, Point, Polygon)
+# Mongo rejects '.' and '$' in keys; they are stored as '__' and as the
+# full-width dollar sign. Older records stored '$' as '____', which cannot be
+# told apart from '..' and has always been read back as '..'.
+_DOLLAR_ESCAPE = u'\uff04'
+_KEY_ESCAPES = {'.': '__', '$': _DOLLAR_ESCAPE}
+_KEY_UNESCAPES = {'__': '.', _DOLLAR_ESCAPE: '$'}
+_KEY_ESCAPE = re.compile(r'[.$]')
+_KEY_UNESCAPE = re.compile(u'__|' + _DOLLAR_ESCAPE)
+
+
+def _escape_key(key):
+    if '.' in key or '$' in key:
+        return _KEY_ESCAPE.sub(lambda match: _KEY_ESCAPES[match.group()], key)
+    return key
+
+
+def _unescape_key(key):
+    if '__' in key or (isinstance(key, unicode) and _DOLLAR_ESCAPE in key):
+        return _KEY_UNESCAPE.sub(lambda match: _KEY_UNESCAPES[match.group()], key)
+    return key
+
+
+# Binary subtypes of stored tensors. gridFS keeps only the bytes, so stored
+# files are told apart by RAW_TENSOR_MAGIC; pickles start with '\x80\x02'.
+PICKLED_TENSOR_SUBTYPE = 128
+RAW_TENSOR_SUBTYPE = 129
+RAW_TENSOR_MAGIC = b'PTT1'
+# Magic followed by the length of the JSON header.
+_RAW_TENSOR_PREFIX = struct.Struct('<4sI')
+# Headers are padded so the raw bytes start on an 8 byte boundary.
+_RAW_TENSOR_ALIGNMENT = 8
+
+# Key marking a state stored as one packed gridFS file plus an offset index.
+PACKED_STATE_KEY = '_packed_state'
+# Byte alignment of each tensor within a packed file.
+PACKED_ALIGNMENT = 64
+
+# Key of the base pointer in records that only store the changed tensors.
+DELTA_KEY = '_delta'
+
+# Key of the list of ObjectIds a stored document refers to, which lets
+# `collect_garbage` find the references to a file without scanning records.
+TENSOR_IDS_KEY = '_tensor_ids'
+
+# gridFS chunk sizes chosen by `_chunk_size`: files are split into about
+# GRIDFS_CHUNKS_PER_FILE chunks of MIN_GRIDFS_CHUNK_SIZE (the gridFS default)
+# to MAX_GRIDFS_CHUNK_SIZE bytes, well below Mongo's 16MB document limit.
+MIN_GRIDFS_CHUNK_SIZE = 255 * 1024
+MAX_GRIDFS_CHUNK_SIZE = 8 * 2 ** 20
+GRIDFS_CHUNKS_PER_FILE = 16
+
+# Indexes created at startup, per collection: 'records' (the experiment
+# collection), 'metrics' (its time series) and 'files' (gridFS metadata).
+# Each entry is (keys, options) as accepted by `create_index`.
+INDEXES = {
+    'records': [
+        ([('exp_id', pm.ASCENDING), ('insertion_date', pm.DESCENDING)], {}),
+        ([('exp_id', pm.ASCENDING), ('step', pm.ASCENDING)], {}),
+        ([(TENSOR_IDS_KEY, pm.ASCENDING)], {}),
+        # Delta records by base, for `delete`.
+        ([(DELTA_KEY + '.base', pm.ASCENDING)], {'sparse': True}),
+        # Checkpoints only, for load_run's {'state': {'$exists': True}} filter
+        # and the sort of `apply_retention`.
+        ([('exp_id', pm.ASCENDING), ('insertion_date', pm.DESCENDING),
+          ('_id', pm.DESCENDING)],
+         {'name': 'exp_id_checkpoints',
+          'partialFilterExpression': {'state': {'$exists': True}}}),
+    ],
+    'metrics': [
+        ([('exp_id', pm.ASCENDING), ('metric', pm.ASCENDING),
+          ('first_step', pm.ASCENDING)], {}),
+    ],
+    'files': [
+        ([('sha1', pm.ASCENDING)], {}),
+    ],
+}
+
+# Sort of queries returning the most recent records first. insertion_date
+# only has millisecond resolution, so ties are broken by the ObjectId.
+NEWEST_FIRST = [('insertion_date', pm.DESCENDING), ('_id', pm.DESCENDING)]
+
+# Compression codecs and lossy float downcasts available to `codecs` rules.
+TENSOR_CODECS = ('zlib', 'lzma', 'shuffle_zlib')
+TENSOR_DOWNCASTS = ('float16', 'bfloat16')
+
+
+def _shuffle(data, itemsize):
+    """Group the bytes of `data` by their position within each item."""
+    return np.frombuffer(data, np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def _unshuffle(data, itemsize):
+    return np.frombuffer(data, np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+def _compress(codec, data, itemsize, level):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    elif codec == 'shuffle_zlib':
+        return zlib.compress(_shuffle(data, itemsize), level)
+    elif codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    raise ValueError('Unknown tensor codec {}'.format(codec))
+
+
+def _decompress(codec, data, itemsize):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'shuffle_zlib':
+        return _unshuffle(zlib.decompress(data), itemsize)
+    elif codec == 'lzma':
+        if lzma is None:
+            raise ImportError('Decoding lzma tensors requires lzma '
+                              '(backports.lzma on Python 2)')
+        return lzma.decompress(data)
+    raise ValueError('Unknown tensor codec {}'.format(codec))
+
+
+def _to_bfloat16(array):
+    """Round float data to bfloat16, stored as the upper half of float32 bits."""
+    bits = np.ascontiguousarray(array, dtype=np.float32).view(np.uint32)
+    rounded = (bits + np.uint32(0x7FFF) + ((bits >> 16) & 1)) >> 16
+    # Keep NaNs NaN instead of letting the rounding carry into the exponent.
+    quiet_nan = (bits >> 16) | np.uint32(0x40)
+    return np.where(np.isnan(array), quiet_nan, rounded).astype(np.uint16)
+
+
+def _from_bfloat16(array):
+    return (array.astype(np.uint32) << 16).view(np.float32)
+
 
 class DBInterface(Base):
     """Interface for all DBInterface subclasses.
@@ -38,6 +207,24 @@ class DBInterface(Base):
 
     `delete(obj)`
         Remove `obj` from the database `self.db_name`.
+
+    and optionally
+
+    `save_metrics(record)`
+        Save a small, tensor-free record (e.g. the loss at one step). Defaults
+        to `save`; interfaces may buffer these records.
+
+    `save_checkpoint(record)`
+        Save a record whose 'state' is a :class:`Snapshot` and release the
+        snapshot once the record is written. Defaults to `save` followed by
+        the release; interfaces may write the record in the background.
+
+    `exists(query)`
+        Return whether any record matches `query`. Defaults to `load`.
+
+    `replay_journal()`
+        Write any records saved to a local journal but not yet to the
+        database. Defaults to doing nothing.
     """
 
     def __init__(self, *args, **kwargs):
@@ -52,6 +239,809 @@ class DBInterface(Base):
     def delete(self):
         raise NotImplementedError()
 
+    def save_metrics(self, record):
+        return self.save(record)
+
+    def save_checkpoint(self, record):
+        try:
+            return self.save(record)
+        finally:
+            self._release_snapshots(record)
+
+    @staticmethod
+    def _release_snapshots(document):
+        for doc in document if isinstance(document, list) else [document]:
+            if isinstance(doc.get('state'), Snapshot):
+                doc['state'].release()
+
+    def exists(self, query):
+        return len(self.load(query)) > 0
+
+    def replay_journal(self, timeout=None):
+        return True
+
+    def sync_with_host(self, sleeptime=0, timeout=None):
+        pass
+
+
+class CheckpointWriterPool(object):
+    """Fixed-size pool of threads that writes records from a bounded queue.
+
+    Records submitted while the queue is full are handled according to
+    `policy`:
+
+        'block': wait until a writer frees a slot.
+        'drop_metrics': discard records without a 'state' (metrics-only
+            records); checkpoints still wait for a free slot.
+        'coalesce': a new checkpoint replaces the most recently queued
+            checkpoint that has not been written yet; other records wait.
+
+    Args:
+        write (callable): Called with each record from a writer thread.
+        num_threads (int): Number of writer threads.
+        max_queued (int): Maximum number of records waiting to be written.
+        policy (str): One of `POLICIES`.
+        discard (callable, optional): Called with each record that is dropped
+            or coalesced instead of written.
+
+    """
+
+    POLICIES = ('block', 'drop_metrics', 'coalesce')
+
+    def __init__(self, write, num_threads=2, max_queued=4, policy='block',
+                 discard=None):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown queue policy {}; expected one of {}'
+                             .format(policy, self.POLICIES))
+        self.write = write
+        self.discard = discard
+        self.max_queued = max(1, max_queued)
+        self.policy = policy
+
+        self._queue = collections.deque()
+        self._unfinished = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._stats = {'submitted': 0, 'written': 0, 'failed': 0,
+                       'dropped': 0, 'coalesced': 0, 'max_queue_depth': 0,
+                       'last_write_seconds': 0.0, 'max_write_seconds': 0.0,
+                       'total_write_seconds': 0.0}
+
+        self._threads = []
+        for i in range(max(1, num_threads)):
+            thread = threading.Thread(target=self._run,
+                                      name='ptutils-writer-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def is_checkpoint(record):
+        """Return True if the record (or any record in a list) holds a state."""
+        records = record if isinstance(record, list) else [record]
+        return any('state' in r for r in records)
+
+    def submit(self, record):
+        """Queue a record for writing.
+
+        Returns:
+            bool: False if the record was dropped because the queue was full.
+
+        """
+        checkpoint = self.is_checkpoint(record)
+        with self._lock:
+            if self._closed:
+                raise ValueError('Cannot submit records to a closed writer pool')
+            self._stats['submitted'] += 1
+            while len(self._queue) >= self.max_queued:
+                if self.policy == 'drop_metrics' and not checkpoint:
+                    self._stats['dropped'] += 1
+                    if self.discard is not None:
+                        self.discard(record)
+                    return False
+                if self.policy == 'coalesce' and checkpoint and self._coalesce():
+                    break
+                self._not_full.wait()
+            self._queue.append(record)
+            self._unfinished += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'],
+                                                 len(self._queue))
+            self._not_empty.notify()
+        return True
+
+    def join(self):
+        """Block until every queued record has been written."""
+        with self._lock:
+            while self._unfinished:
+                self._all_done.wait()
+
+    def close(self):
+        """Write the queued records, then stop the writer threads.
+
+        Later calls do nothing; `submit` raises a ValueError once closed.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._not_empty.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """Return a snapshot of the queue depth and write latency counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+            stats['in_flight'] = self._unfinished - len(self._queue)
+        completed = stats['written'] + stats['failed']
+        stats['mean_write_seconds'] = (stats['total_write_seconds'] / completed
+                                       if completed else 0.0)
+        return stats
+
+    def _coalesce(self):
+        """Remove the newest queued checkpoint. Caller must hold the lock."""
+        for index in reversed(range(len(self._queue))):
+            if self.is_checkpoint(self._queue[index]):
+                if self.discard is not None:
+                    self.discard(self._queue[index])
+                del self._queue[index]
+                self._unfinished -= 1
+                self._stats['coalesced'] += 1
+                return True
+        return False
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return
+                record = self._queue.popleft()
+                self._not_full.notify()
+
+            start = time.time()
+            try:
+                self.write(record)
+                failed = False
+            except Exception:
+                log.exception('Failed to write record to the database')
+                failed = True
+            elapsed = time.time() - start
+
+            with self._lock:
+                self._stats['failed' if failed else 'written'] += 1
+                self._stats['last_write_seconds'] = elapsed
+                self._stats['total_write_seconds'] += elapsed
+                self._stats['max_write_seconds'] = max(
+                    self._stats['max_write_seconds'], elapsed)
+                self._unfinished -= 1
+                if not self._unfinished:
+                    self._all_done.notify_all()
+
+
+class CheckpointJournal(object):
+    """Local append-only journal of records waiting to be written.
+
+    `append` pickles a record, tensors included, to the newest segment file in
+    `directory` and returns at once. A replayer thread passes the records to
+    `write` in the order they were appended and deletes each segment once all
+    of its records have been written, so the journal only holds the records
+    that have not reached the database yet. Records still in the journal when
+    the process dies are replayed by the next journal opened on `directory`.
+
+    Each record is framed by a header holding the payload length, a sequence
+    number and the CRC-32 of the payload. A frame that is cut short or fails
+    its checksum, as left by a crash during an append, ends its segment.
+
+    Writes failing with a `pymongo.errors.ConnectionFailure` are retried every
+    `retry_seconds` until they succeed; other failures are logged and the
+    record is skipped. A record that cannot be unpickled is skipped too, and
+    its payload is moved aside to a '.quarantine' file named after its
+    sequence number. Both count as failed.
+
+    Only one process at a time may use a journal directory; opening a journal
+    on a directory locked by another process raises a ParamError.
+
+    Args:
+        directory (str): Where segment files are kept. Created if needed.
+        write (callable): Called with each record from the replayer thread.
+        segment_bytes (int): Size after which appends start a new segment.
+        fsync (bool): Whether `append` waits for the record to reach the disk,
+            not just the operating system.
+        retry_seconds (float): Wait between attempts to write a record.
+
+    """
+
+    HEADER = struct.Struct('<IQI')
+    SUFFIX = '.journal'
+
+    def __init__(self, directory, write, segment_bytes=2 ** 26, fsync=False,
+                 retry_seconds=5.0):
+        self.directory = directory
+        self.write = write
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.retry_seconds = retry_seconds
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._lock_file = open(os.path.join(directory, 'LOCK'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self._lock_file.close()
+                raise ParamError('Journal {} is in use by another process'
+                                 .format(directory))
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._file = None
+        self._segments = collections.deque()
+        self._sizes = {}
+        self._pending = 0
+        self._next_sequence = 0
+        # Where the replayer stopped in the oldest segment.
+        self._offset = 0
+        self._stats = {'appended': 0, 'written': 0, 'failed': 0, 'retried': 0}
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(self.SUFFIX):
+                self._recover(os.path.join(directory, name))
+        if self._pending:
+            log.info('Replaying {} journaled records from {}'.format(
+                self._pending, directory))
+
+        self._thread = threading.Thread(target=self._run, name='ptutils-journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, record):
+        """Add a record to the journal; it is written in the background."""
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._file is None or self._sizes[self._file.name] >= self.segment_bytes:
+                self._start_segment()
+            header = self.HEADER.pack(len(payload), self._next_sequence,
+                                      zlib.crc32(payload) & 0xffffffff)
+            self._file.write(header)
+            self._file.write(payload)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._next_sequence += 1
+            self._sizes[self._file.name] += len(header) + len(payload)
+            self._pending += 1
+            self._stats['appended'] += 1
+            self._changed.notify_all()
+
+    def pending(self):
+        """Return the number of records not written yet."""
+        with self._lock:
+            return self._pending
+
+    def join(self, timeout=None):
+        """Block until every appended record has been written.
+
+        Returns:
+            bool: False if records were still pending after `timeout` seconds.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def stats(self):
+        """Return counters of appended, written, failed and retried records."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = self._pending
+            stats['segments'] = len(self._segments)
+        return stats
+
+    def _recover(self, path):
+        """Queue the intact records of a segment left by an earlier journal."""
+        count, end = 0, 0
+        with open(path, 'rb') as f:
+            for sequence, _, end in self._frames(f, os.path.getsize(path)):
+                self._next_sequence = max(self._next_sequence, sequence + 1)
+                count += 1
+        if not count:
+            os.remove(path)
+            return
+        self._segments.append(path)
+        self._sizes[path] = end
+        self._pending += count
+
+    def _frames(self, f, end):
+        """Yield the (sequence, payload, end offset) of each intact frame."""
+        while f.tell() + self.HEADER.size <= end:
+            length, sequence, crc = self.HEADER.unpack(f.read(self.HEADER.size))
+            if f.tell() + length > end:
+                log.warning('Ignoring truncated record in {}'.format(f.name))
+                return
+            payload = f.read(length)
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                log.warning('Ignoring corrupt record in {}'.format(f.name))
+                return
+            yield sequence, payload, f.tell()
+
+    def _start_segment(self):
+        """Close the current segment and append to a new one. Caller must hold the lock."""
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory,
+                            '{:020d}{}'.format(self._next_sequence, self.SUFFIX))
+        self._file = open(path, 'ab')
+        self._segments.append(path)
+        self._sizes[path] = 0
+
+    def _run(self):
+        while True:
+            try:
+                self._replay_segment()
+            except Exception:
+                # Keep the thread alive; the records are still journaled.
+                log.exception('Journal replayer failed, retrying in {}s'.format(
+                    self.retry_seconds))
+                time.sleep(self.retry_seconds)
+
+    def _replay_segment(self):
+        """Write the records of the oldest segment from where the last call stopped."""
+        with self._lock:
+            while not self._pending:
+                self._changed.wait()
+            path = self._segments[0]
+            end = self._sizes[path]
+
+        with open(path, 'rb') as f:
+            f.seek(self._offset)
+            for sequence, payload, offset in self._frames(f, end):
+                try:
+                    record = pickle.loads(payload)
+                except Exception:
+                    self._quarantine(sequence, payload)
+                else:
+                    self._replay(record)
+                with self._lock:
+                    # Delete a finished segment before `join` can return.
+                    if offset == self._sizes[path]:
+                        self._remove_segment(path)
+                        offset = 0
+                    self._offset = offset
+                    self._pending -= 1
+                    self._changed.notify_all()
+
+    def _quarantine(self, sequence, payload):
+        """Move an unreadable record aside and count it as failed."""
+        path = os.path.join(self.directory, '{:020d}.quarantine'.format(sequence))
+        log.exception('Moving unreadable journaled record to {}'.format(path))
+        with open(path, 'wb') as f:
+            f.write(payload)
+        with self._lock:
+            self._stats['failed'] += 1
+
+    def _remove_segment(self, path):
+        """Delete a segment whose records were all written. Caller must hold the lock."""
+        if self._file is not None and self._file.name == path:
+            self._file.close()
+            self._file = None
+        self._segments.popleft()
+        del self._sizes[path]
+        os.remove(path)
+
+    def _replay(self, record):
+        """Write a record, retrying while the database is unreachable."""
+        while True:
+            try:
+                self.write(record)
+            except pm.errors.ConnectionFailure as e:
+                log.warning('Journal replay failed, retrying in {}s: {}'.format(
+                    self.retry_seconds, e))
+                with self._lock:
+                    self._stats['retried'] += 1
+                time.sleep(self.retry_seconds)
+                continue
+            except Exception:
+                log.exception('Failed to write journaled record to the database')
+                failed = True
+            else:
+                failed = False
+            with self._lock:
+                self._stats['failed' if failed else 'written'] += 1
+            return
+
+
+# Open journals by (real path, target), where target is the (host, port,
+# database_name, collection_name) their records are written to.
+_JOURNALS = {}
+_JOURNALS_LOCK = threading.Lock()
+
+
+def _open_journal(directory, target, write, **options):
+    """Return the process-wide journal of `directory`, opening it on first use.
+
+    Interfaces writing to the same `target` share the journal, whose records
+    are written by the `write` of the interface that opened it. A directory
+    cannot hold the journal of two targets.
+    """
+    path = os.path.realpath(directory)
+    with _JOURNALS_LOCK:
+        if (path, target) not in _JOURNALS:
+            for other_path, other_target in _JOURNALS:
+                if other_path == path:
+                    raise ParamError('Journal {} already holds the records of {}'
+                                     .format(directory, other_target))
+            _JOURNALS[path, target] = CheckpointJournal(directory, write, **options)
+        return _JOURNALS[path, target]
+
+
+class TensorStream(object):
+    """Read-only file-like object over the segments of an encoded tensor.
+
+    Segments are bytes or numpy arrays, typically the header of a tensor and
+    the tensor's own memory. `read` copies only the bytes it returns, so a
+    tensor can be uploaded chunk by chunk without first being joined into
+    one bytes object.
+
+    Args:
+        segments (list): bytes or C-contiguous numpy arrays.
+
+    """
+
+    def __init__(self, segments):
+        self._segments = [np.frombuffer(segment, np.uint8) if isinstance(segment, bytes)
+                          else segment.reshape(-1).view(np.uint8)
+                          for segment in segments]
+        self._segments = [segment for segment in self._segments if len(segment)]
+        self._index = 0
+        self._offset = 0
+
+    def __len__(self):
+        return sum(len(segment) for segment in self._segments)
+
+    def sha1(self):
+        """Return the SHA-1 hex digest of the whole stream."""
+        digest = hashlib.sha1()
+        for segment in self._segments:
+            digest.update(segment)
+        return digest.hexdigest()
+
+    def read(self, size=-1):
+        pieces = []
+        while self._index < len(self._segments) and size != 0:
+            segment = self._segments[self._index]
+            end = len(segment) if size < 0 else min(len(segment), self._offset + size)
+            pieces.append(segment[self._offset:end].tobytes())
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+            if end == len(segment):
+                self._index += 1
+                self._offset = 0
+        return b''.join(pieces)
+
+
+class TensorProxy(object):
+    """Placeholder for a stored tensor that is only fetched when used.
+
+    Returned in place of tensors by `MongoInterface.load(..., lazy=True)`. The
+    tensor is fetched and decoded by `materialize()`, or implicitly by the
+    first access to any of its attributes, and cached on the proxy.
+
+    Args:
+        fetch (callable): Returns the tensor when called without arguments.
+        file_id (ObjectId, optional): gridFS file holding the tensor.
+
+    """
+
+    def __init__(self, fetch, file_id=None):
+        self.file_id = file_id
+        self._fetch = fetch
+        self._tensor = None
+        self._lock = threading.Lock()
+
+    @property
+    def materialized(self):
+        return self._tensor is not None
+
+    def materialize(self):
+        """Return the tensor, fetching it on the first call."""
+        with self._lock:
+            if self._tensor is None:
+                self._tensor = self._fetch()
+                self._fetch = None
+        return self._tensor
+
+    def __getattr__(self, name):
+        # Only reached for attributes the proxy itself does not define.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def __getitem__(self, index):
+        return self.materialize()[index]
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.materialize(), dtype=dtype)
+
+    def __repr__(self):
+        if self.materialized:
+            return 'TensorProxy({!r})'.format(self._tensor)
+        return 'TensorProxy(file_id={})'.format(self.file_id)
+
+
+def materialize(value):
+    """Replace every :class:`TensorProxy` within `value` by its tensor."""
+    if isinstance(value, TensorProxy):
+        return value.materialize()
+    elif isinstance(value, dict):
+        return type(value)((k, materialize(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return [materialize(v) for v in value]
+    elif isinstance(value, tuple):
+        return tuple(materialize(v) for v in value)
+    return value
+
+
+class BlobCache(object):
+    """Size-bounded local directory cache of gridFS file contents.
+
+    Each cached file is stored under its key (the content hash of a file, or
+    its ObjectId). Writes go to a temporary file that is renamed into place,
+    so readers in other processes never see a partial file. Reads return a
+    copy-on-write memory map of the cached file. The size of the directory is
+    tracked in memory; once it exceeds `max_bytes`, the directory is scanned
+    and the least recently used files are evicted. Use is tracked through
+    file modification times so that it is shared across processes.
+
+    Args:
+        directory (str): Cache directory; created if missing.
+        max_bytes (int): Size above which files are evicted.
+
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._total_bytes = sum(size for _, size, _ in self._entries())
+
+    def get(self, key):
+        """Return a memory map of the cached file, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                data = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+                        if size else bytearray())
+            os.utime(path, None)
+        except (IOError, OSError):
+            self._count('misses')
+            return None
+        self._count('hits')
+        return data
+
+    def put(self, key, data):
+        """Atomically store `data` under `key`, then evict old files."""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            try:
+                replaced = os.path.getsize(self._path(key))
+            except OSError:
+                replaced = 0
+            os.rename(temp_path, self._path(key))
+        except (IOError, OSError) as e:
+            log.warning('Could not cache {}: {}'.format(key, e))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._total_bytes += len(data) - replaced
+            if self._total_bytes <= self.max_bytes:
+                return
+        self._evict()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else 0.0
+        return stats
+
+    def _path(self, key):
+        return os.path.join(self.directory, str(key))
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _entries(self):
+        """Return the (mtime, size, name) of every cached file."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, name))
+        return entries
+
+    def _evict(self):
+        # Rescan, as other processes may share the directory.
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                self._count('evictions')
+            except OSError:
+                pass
+            total -= size
+        with self._lock:
+            self._total_bytes = total
+
+
+class MongoClientRegistry(object):
+    """Process-wide MongoClients shared by the interfaces of a server.
+
+    `acquire` returns the client for (host, port, options), creating it on
+    first use, and `release` closes it once every interface that acquired
+    it has released it. GridFS handles are shared per client and database,
+    and the indexes of each collection are created once per client (see
+    `MongoInterface.ensure_indexes`).
+
+    Options are keyed by their JSON encoding, so that unhashable values such
+    as lists of event listeners can be passed; values JSON cannot encode are
+    keyed by their repr.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._keys = {}
+        self._filesystems = {}
+        self._indexed = set()
+
+    def acquire(self, host='localhost', port=27017, **options):
+        key = (host, port, json.dumps(options, sort_keys=True, default=repr))
+        with self._lock:
+            if key not in self._clients:
+                client = pm.MongoClient(host, port, **options)
+                self._clients[key] = [client, 0]
+                self._keys[id(client)] = key
+            entry = self._clients[key]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, client):
+        """Drop one reference to `client`, closing it when unused."""
+        with self._lock:
+            key = self._keys.get(id(client))
+            if key is None:
+                return
+            entry = self._clients[key]
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._clients[key]
+            del self._keys[id(client)]
+            for fs_key in [k for k in self._filesystems if k[0] == key]:
+                del self._filesystems[fs_key]
+            self._indexed = set(k for k in self._indexed if k[0] != key)
+        client.close()
+
+    def gridfs(self, client, database_name):
+        """Return the shared GridFS handle of a database of `client`."""
+        with self._lock:
+            fs_key = (self._keys.get(id(client)), database_name)
+            if fs_key not in self._filesystems:
+                self._filesystems[fs_key] = gridfs.GridFS(client[database_name])
+            return self._filesystems[fs_key]
+
+    def needs_indexes(self, client, database_name, collection_name):
+        """Return whether the indexes of a collection are yet to be created."""
+        with self._lock:
+            return ((self._keys.get(id(client)), database_name, collection_name)
+                    not in self._indexed)
+
+    def mark_indexed(self, client, database_name, collection_name):
+        """Record that the indexes of a collection of `client` exist."""
+        with self._lock:
+            self._indexed.add((self._keys.get(id(client)), database_name,
+                               collection_name))
+
+    def stats(self):
+        """Return the number of references to each client, by key."""
+        with self._lock:
+            return {key: entry[1] for key, entry in self._clients.items()}
+
+
+CLIENTS = MongoClientRegistry()
+
+
+def _metric_points(record):
+    """Return the (exp_id, name, step, value) points of a metrics record.
+
+    Raises:
+        ParamError: The record lacks 'exp_id' or 'step', or holds a value
+            that is not a scalar.
+
+    """
+    record = MongoInterface._extract_data_from_variables(record)
+    if 'exp_id' not in record or 'step' not in record:
+        raise ParamError('Metrics records need an exp_id and a step')
+    points = []
+    for name, value in record.items():
+        if name in ('exp_id', 'step', '_id', 'insertion_date'):
+            continue
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ParamError('Metric {} is not a scalar: {!r}'.format(name, value))
+        points.append((record['exp_id'], name, int(record['step']), value))
+    return points
+
+
+def _flush_metrics_at_exit(reference):
+    dbinterface = reference()
+    if dbinterface is not None:
+        try:
+            dbinterface.flush_metrics()
+        except (pm.errors.PyMongoError, sqlite3.Error) as e:
+            log.warning('Could not flush buffered metrics: {}'.format(e))
+
+
+def _register_exit_flush(dbinterface):
+    """Flush the buffered metrics of `dbinterface` at exit, if still alive.
+
+    Returns the registered handler, for `_unregister_exit_flush`.
+    """
+    handler = partial(_flush_metrics_at_exit, weakref.ref(dbinterface))
+    atexit.register(handler)
+    return handler
+
+
+def _unregister_exit_flush(handler):
+    if hasattr(atexit, 'unregister'):
+        atexit.unregister(handler)
+    else:
+        # Python 2 has no atexit.unregister.
+        atexit._exithandlers[:] = [entry for entry in atexit._exithandlers
+                                   if entry[0] is not handler]
+
 
 class MongoInterface(DBInterface):
     """Simple and lightweight mongodb interface for saving experimental data files."""
@@ -61,6 +1051,31 @@ class MongoInterface(DBInterface):
                  collection_name,
                  host='localhost',
                  port=27017,
+                 content_addressed=True,
+                 codecs=None,
+                 packed_state=False,
+                 delta_state=False,
+                 full_state_every=10,
+                 writer_threads=2,
+                 max_queued_writes=4,
+                 queue_policy='block',
+                 load_threads=4,
+                 cache_dir=None,
+                 cache_max_bytes=2 ** 30,
+                 metric_buffer_size=100,
+                 metric_flush_interval=5.0,
+                 metrics_collection_name=None,
+                 metric_bucket_size=1000,
+                 retention=None,
+                 explain_queries=False,
+                 client_options=None,
+                 journal_dir=None,
+                 journal_segment_bytes=2 ** 26,
+                 journal_fsync=False,
+                 journal_timeout=60.0,
+                 chunk_size=None,
+                 snapshot_buffers=2,
+                 snapshot_pin_memory=False,
                  **kwargs):
         super(MongoInterface, self).__init__(**kwargs)
 
@@ -68,21 +1083,106 @@ class MongoInterface(DBInterface):
         self.port = port
         self.database_name = database_name
         self.collection_name = collection_name
-
-        self.checkpoint_threads = []
-        self.client = pm.MongoClient(self.host, self.port)
+        # Store each distinct tensor payload once and reference count it.
+        self.content_addressed = content_addressed
+        # Rules choosing a compression codec per tensor (see `_select_codec`).
+        self.codecs = codecs
+        self._codec_rules = self._compile_codecs(codecs or [])
+        # Store a record's 'state' as a single gridFS file (see `_pack_state`).
+        self.packed_state = packed_state
+        # Store only the tensors that changed since the last state of the same
+        # exp_id, with a full state at least every `full_state_every` saves.
+        self.delta_state = delta_state
+        self.full_state_every = full_state_every
+        self._delta_heads = {}
+        self._delta_lock = threading.Lock()
+        # Background writers used by `save(multithreaded=True)`.
+        self.writer_threads = writer_threads
+        self.max_queued_writes = max_queued_writes
+        self.queue_policy = queue_policy
+
+        self._writer_pool = None
+        # Reused CPU copies of the states queued for the writers.
+        self.snapshot_buffers = snapshot_buffers
+        self.snapshot_pin_memory = snapshot_pin_memory
+        self._snapshots = SnapshotBuffers(snapshot_buffers, snapshot_pin_memory)
+        # Threads fetching gridFS files in `load`.
+        self.load_threads = load_threads
+        self._reader_pool = None
+        # Optional local cache of downloaded gridFS files.
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self._cache = (BlobCache(cache_dir, cache_max_bytes)
+                       if cache_dir is not None else None)
+        # gridFS chunk size of stored tensors; None sizes chunks by file size.
+        self.chunk_size = chunk_size
+        # Values passed to `save_metrics` are buffered and written together
+        # once `metric_buffer_size` values or `metric_flush_interval` seconds
+        # have accumulated.
+        self.metric_buffer_size = metric_buffer_size
+        self.metric_flush_interval = metric_flush_interval
+        self._metric_buffer = []
+        self._metric_lock = threading.Lock()
+        self._metric_flush_time = time.time()
+        # Metrics are stored apart from the records, in buckets of at most
+        # `metric_bucket_size` (step, value) pairs per exp_id and metric.
+        self.metrics_collection_name = metrics_collection_name
+        self.metric_bucket_size = metric_bucket_size
+        # Which checkpoints of an exp_id to keep (see `apply_retention`),
+        # enforced in the background after each checkpoint is saved.
+        self.retention = retention
+        self._check_retention(retention)
+        self._retention_pool = None
+        self._retention_results = []
+        self._retention_lock = threading.Lock()
+        self._exit_flush = _register_exit_flush(self)
+        # Interfaces to the same server share one client (see CLIENTS).
+        self.client_options = client_options
+        self.client = CLIENTS.acquire(self.host, self.port, **(client_options or {}))
         self.database = self.client[self.database_name]
 
-        if self.collection_name not in self.database.collection_names():
-            print('making exp_id index')
-            self.collection = self.database[self.collection_name]
-            self.collection.create_index('exp_id')
-        else:
-            self.collection = self.database[self.collection_name]
-
-        self.filesystem = gridfs.GridFS(self.database)
+        self.collection = self.database[self.collection_name]
+        self.filesystem = CLIENTS.gridfs(self.client, self.database_name)
+        self.files = self.database['fs.files']
+        self.chunks = self.database['fs.chunks']
+        self.metrics = self.database[metrics_collection_name or
+                                     self.collection_name + '.metrics']
+        self.ensure_indexes(once=True)
+
+        # Record an explain() summary of each query pattern issued, and warn
+        # about collection scans (see `query_plans`).
+        self.explain_queries = explain_queries
+        self._query_plans = {}
+        self._query_plans_lock = threading.Lock()
+
+        # Records passed to `save` are appended to a local journal and written
+        # to the database by its replayer thread (see CheckpointJournal).
+        self.journal_dir = journal_dir
+        self.journal_segment_bytes = journal_segment_bytes
+        self.journal_fsync = journal_fsync
+        # Longest wait for the journal in `sync_with_host` and the queries
+        # that call it, so an unreachable database cannot hang them; None
+        # waits until every record is written.
+        self.journal_timeout = journal_timeout
+        self._journal = None
+        if journal_dir is not None:
+            self._journal = _open_journal(
+                os.path.join(journal_dir, '{}_{}'.format(self.host, self.port),
+                             self.database_name, self.collection_name),
+                (self.host, self.port, self.database_name, self.collection_name),
+                self._save_journaled,
+                segment_bytes=journal_segment_bytes,
+                fsync=journal_fsync)
         self._exclude_from_params = ['client', 'database', 'collection',
-                                     'filesystem', 'checkpoint_threads',
+                                     'filesystem', 'files', 'chunks', 'metrics',
+                                     '_writer_pool', '_reader_pool', '_cache',
+                                     '_delta_heads', '_delta_lock', '_codec_rules',
+                                     '_metric_buffer', '_metric_lock',
+                                     '_metric_flush_time',
+                                     '_retention_pool', '_retention_results',
+                                     '_retention_lock', '_exit_flush',
+                                     '_query_plans', '_query_plans_lock',
+                                     '_journal', '_snapshots',
                                      '_old_tensor_ids', '_new_tensor_ids',
                                      '_tensor_ids']
 
@@ -90,8 +1190,24 @@ class MongoInterface(DBInterface):
     def from_params(cls, database_name, collection_name, **params):
         return cls(database_name, collection_name, **params)
 
+    def close(self):
+        """Write what is pending, stop the background threads and release
+        the shared client."""
+        if self.client is not None:
+            self.sync_with_host()
+            _unregister_exit_flush(self._exit_flush)
+            if self._writer_pool is not None:
+                self._writer_pool.close()
+            for pool in (self._reader_pool, self._retention_pool):
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            self._reader_pool = self._retention_pool = None
+            CLIENTS.release(self.client)
+            self.client = None
+
     def _close(self):
-        self.client.close()
+        self.close()
 
     # def __del__(self):
         # self._close()
@@ -119,7 +1235,24 @@ class MongoInterface(DBInterface):
         also be stored in the 'tensor_id' key-value pair.  If re-saving an
         object- the method will check for old gridfs objects and delete them.
 
-        If multithreaded is true, calls private _save method to spawn new thread.
+        If multithreaded is true, the document is queued for one of the
+        `writer_threads` background writers. At most `max_queued_writes`
+        documents wait in the queue; `queue_policy` decides what happens to
+        further documents (see :class:`CheckpointWriterPool`). The 'state' of a
+        queued document is first copied into one of `snapshot_buffers` reused
+        CPU buffers (see :class:`SnapshotBuffers`), so the stored state is the
+        one at the time of the call even if its tensors change afterwards.
+        With `snapshot_pin_memory`, the buffers are page-locked. While every
+        buffer is held by a queued document, the state is copied into newly
+        allocated tensors instead: the call never waits for a buffer, only for
+        the queue as `queue_policy` says.
+
+        A 'state' that is already a :class:`Snapshot` is not copied again.
+        The interface releases it once the document has been written.
+
+        With a `journal_dir`, the document is instead appended to the local
+        journal and written by its replayer thread, whatever `multithreaded`
+        is, and the ObjectIds it will be stored under are returned at once.
 
         Args:
             document: dictionary of arbitrary size and structure,
@@ -130,50 +1263,207 @@ class MongoInterface(DBInterface):
             id_values: list of ObjectIds of the inserted object(s).
 
         """
+        if self._journal is not None:
+            try:
+                return self._journal_documents(document)
+            finally:
+                self._release_snapshots(document)
         if multithreaded:
-            thread = threading.Thread(target=self._save, args=(document,))
-            thread.daemon = True
-            thread.start()
-            self.checkpoint_threads.append(thread)
+            if self._writer_pool is None:
+                self._writer_pool = CheckpointWriterPool(
+                    self._save_snapshots,
+                    num_threads=self.writer_threads,
+                    max_queued=self.max_queued_writes,
+                    policy=self.queue_policy,
+                    discard=self._release_snapshots)
+            self._writer_pool.submit(self._snapshot(document))
         else:
-            return self._save(document)
+            return self._save_snapshots(document)
+
+    def save_checkpoint(self, record):
+        """Save a record whose 'state' is a Snapshot; see `save`.
+
+        `save` releases the snapshot itself once the record is written, so a
+        multithreaded save returns as soon as the record is queued.
+        """
+        return self.save(record)
+
+    def save_metrics(self, record):
+        """Buffer the scalar metrics of a record (or list of records).
+
+        A metrics record holds an 'exp_id', a 'step' and any number of scalar
+        values, e.g. ``{'exp_id': 'mnist', 'step': 10, 'loss': 0.3}``. Each
+        value is appended to the time series of its metric for that exp_id
+        (see `load_metrics`). Values are written together once
+        `metric_buffer_size` of them are waiting or `metric_flush_interval`
+        seconds have passed, and on `sync_with_host` and interpreter exit.
+
+        Raises:
+            ParamError: A record lacks 'exp_id' or 'step', or holds a value
+                that is not a scalar.
 
-    def load_from_ids(self, ids):
+        """
+        if not isinstance(record, list):
+            record = [record]
+
+        points = [point for doc in record for point in _metric_points(doc)]
+
+        with self._metric_lock:
+            self._metric_buffer.extend(points)
+            flush = (len(self._metric_buffer) >= self.metric_buffer_size or
+                     time.time() - self._metric_flush_time >= self.metric_flush_interval)
+        if flush:
+            self.flush_metrics()
+
+    def flush_metrics(self):
+        """Append all values buffered by `save_metrics` to their buckets."""
+        with self._metric_lock:
+            buffered, self._metric_buffer = self._metric_buffer, []
+            self._metric_flush_time = time.time()
+        if not buffered:
+            return
+
+        series = collections.OrderedDict()
+        for exp_id, name, step, value in buffered:
+            series.setdefault((exp_id, name), []).append((step, value))
+
+        requests = []
+        for (exp_id, name), points in series.items():
+            for start in range(0, len(points), self.metric_bucket_size):
+                steps, values = zip(*points[start:start + self.metric_bucket_size])
+                requests.append(pm.UpdateOne(
+                    {'exp_id': exp_id, 'metric': name,
+                     'count': {'$lte': self.metric_bucket_size - len(steps)}},
+                    {'$push': {'steps': {'$each': list(steps)},
+                               'values': {'$each': list(values)}},
+                     '$inc': {'count': len(steps)},
+                     '$min': {'first_step': min(steps)},
+                     '$max': {'last_step': max(steps)},
+                     '$setOnInsert': {TENSOR_IDS_KEY: []}},
+                    upsert=True))
+        self.metrics.bulk_write(requests, ordered=True)
+
+    def load_metrics(self, exp_id, names=None, step_range=None):
+        """Load the time series saved with `save_metrics`.
+
+        Only the metric buckets are read; the records of the collection are
+        not touched.
+
+        Args:
+            exp_id: Experiment ID of the metrics.
+            names (str or list, optional): Metrics to load; all by default.
+            step_range (tuple, optional): ``(start, stop)`` steps to keep,
+                stop excluded. Either bound may be None.
+
+        Returns:
+            metrics (dict): maps each metric name to a ``(steps, values)``
+                tuple of NumPy arrays sorted by step.
+
+        """
+        self.flush_metrics()
+        query = {'exp_id': exp_id}
+        if names is not None:
+            if isinstance(names, basestring):
+                names = [names]
+            query['metric'] = {'$in': names}
+        start, stop = step_range or (None, None)
+        if start is not None:
+            query['last_step'] = {'$gte': start}
+        if stop is not None:
+            query['first_step'] = {'$lt': stop}
+
+        buckets = collections.defaultdict(lambda: ([], []))
+        self._explain(self.metrics, query)
+        for bucket in self.metrics.find(query, {'metric': 1, 'steps': 1, 'values': 1}):
+            steps, values = buckets[bucket['metric']]
+            steps.extend(bucket['steps'])
+            values.extend(bucket['values'])
+
+        metrics = {}
+        for name, (steps, values) in buckets.items():
+            steps = np.array(steps, dtype=np.int64)
+            values = np.array(values, dtype=np.float64)
+            keep = np.ones(len(steps), dtype=bool)
+            if start is not None:
+                keep &= steps >= start
+            if stop is not None:
+                keep &= steps < stop
+            order = np.argsort(steps[keep], kind='mergesort')
+            metrics[name] = (steps[keep][order], values[keep][order])
+        return metrics
+
+    def checkpoint_stats(self):
+        """Return queue depth and write latency counters of the writer pool."""
+        if self._writer_pool is None:
+            return {}
+        return self._writer_pool.stats()
+
+    def cache_stats(self):
+        """Return hit, miss and eviction counts of the local file cache."""
+        if self._cache is None:
+            return {}
+        return self._cache.stats()
+
+    def load_from_ids(self, ids, get_tensors=True, lazy=False, projection=None):
         """Conveience function to load from a list of ObjectIds or from their
          string representations.  Takes a singleton or a list of either type.
 
+        All documents are fetched with one query and their tensors in one
+        pass (see `_fetch_files`).
+
         Args:
             ids: can be an ObjectId, string representation of an ObjectId,
             or a list containing items of either type.
+            get_tensors, lazy, projection: as in `load`.
 
         Returns:
-            out: list of documents from the DB.  If a document w/the object
-                did not exist, a None object is returned instead.
+            out: list of documents from the DB, in the order of `ids`.  If a
+                document w/the object did not exist, a None object is returned
+                instead.
 
         """
         self.sync_with_host()
         if type(ids) is not list:
             ids = [ids]
 
-        out = []
-
+        obj_ids = []
         for id in ids:
-            if type(id) is ObjectId:
-                obj_id = id
-            elif type(id) is str or type(id) is unicode:
+            if isinstance(id, basestring):
                 try:
-                    obj_id = ObjectId(id)
-                except TypeError:
-                    obj_id = id
-            out.append(self.load({'_id': obj_id}))
-
-        return out
-
-    def load(self, query, get_tensors=True, from_load_run=False, return_all=False):
+                    id = ObjectId(id)
+                except (TypeError, bson.errors.InvalidId):
+                    pass
+            obj_ids.append(id)
+
+        # '_id' is needed to put the documents in the order of `ids`.
+        projection = self._projection(projection)
+        keep_id = projection is None or projection.pop('_id', True)
+        query = {'_id': {'$in': list(set(obj_ids))}}
+        self._explain(self.collection, query)
+        results = self.collection.find(query, projection or None)
+        found = {doc['_id']: doc
+                 for doc in self._resolve(list(results), get_tensors, lazy)}
+        if not keep_id:
+            for doc in found.values():
+                doc.pop('_id')
+        return [found.get(obj_id) for obj_id in obj_ids]
+
+    def load(self, query, get_tensors=True, from_load_run=False, return_all=False,
+             lazy=False, projection=None):
         """Perform a search using the presented query.
 
+        Records saved with `delta_state` only hold the tensors that changed
+        since their base record. If `get_tensors` is set, the chain of base
+        records is followed and the full state is returned.
+
         Args:
             query: dictionary of key-value pairs to use for querying the mongodb
+            lazy (bool, optional): If True (and `get_tensors` is set), tensors
+                are returned as :class:`TensorProxy` objects that fetch their
+                data on first use instead of being downloaded right away.
+            projection (list or dict, optional): Fields to return, as a list
+                of field names or a mongodb projection dict. Only the tensors
+                of the returned fields are fetched.
 
         Returns:
             all_results: list of full documents from the collection
@@ -181,49 +1471,385 @@ class MongoInterface(DBInterface):
         """
         self.sync_with_host()
         if from_load_run is False:
-            query = self._mongoify(query)
+            query = self._mongoify_query(query)
+        projection = self._projection(projection)
+        self._explain(self.collection, query, NEWEST_FIRST)
         if return_all is False:
-            results = self.collection.find(query, sort=[('insertion_date', -1)]).limit(1)
+            results = self.collection.find(query, projection,
+                                           sort=NEWEST_FIRST).limit(1)
         else:
-            results = self.collection.find(query, sort=[('insertion_date', -1)])
+            results = self.collection.find(query, projection,
+                                           sort=NEWEST_FIRST)
         # results = self.collection.find(query, sort=[('insertion_date', -1)])
 
-        if get_tensors:
-            all_results = [self._de_mongoify(
-                self._load_tensor(doc)) for doc in results]
-        else:
-            all_results = [self._de_mongoify(doc) for doc in results]
+        return self._resolve(list(results), get_tensors, lazy)
 
-        return all_results
+    def iter_load(self, query, get_tensors=True, lazy=False, projection=None,
+                  batch_size=100, limit=0):
+        """Iterate over the records matching `query`, most recent first.
+
+        Unlike `load(return_all=True)`, records are fetched from the server
+        `batch_size` at a time and only one batch is held in memory. The
+        tensors of a batch are fetched together, as in `load`. Stopping the
+        iteration (or closing the generator) closes the server cursor.
+
+        Args:
+            query: dictionary of key-value pairs to use for querying the mongodb
+            get_tensors, lazy, projection: as in `load`.
+            batch_size (int, optional): Number of records per server batch.
+            limit (int, optional): Maximum number of records; 0 for no limit.
+
+        Yields:
+            document: one full document from the collection.
+
+        """
+        self.sync_with_host()
+        query = self._mongoify_query(query)
+        self._explain(self.collection, query, NEWEST_FIRST)
+        cursor = self.collection.find(query,
+                                      self._projection(projection),
+                                      sort=NEWEST_FIRST,
+                                      limit=limit,
+                                      batch_size=batch_size)
+        try:
+            batch = []
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) == batch_size:
+                    for result in self._resolve(batch, get_tensors, lazy):
+                        yield result
+                    batch = []
+            for result in self._resolve(batch, get_tensors, lazy):
+                yield result
+        finally:
+            cursor.close()
+
+    def exists(self, query):
+        """Return whether any record matches `query`, without loading it."""
+        self.sync_with_host()
+        query = self._mongoify_query(query)
+        self._explain(self.collection, query)
+        return self.collection.find_one(query, projection={'_id': True}) is not None
+
+    def count(self, query=None):
+        """Return the number of records matching `query`."""
+        self.sync_with_host()
+        query = self._mongoify_query(query or {})
+        self._explain(self.collection, query)
+        return self.collection.count(query)
+
+    def latest(self, exp_id, field):
+        """Return `field` of the most recent record of `exp_id` that has it.
+
+        Only that field is read; tensors it holds are returned as the
+        ObjectIds of their gridFS files.
+
+        Args:
+            exp_id: Experiment ID of the record.
+            field (str): Field name, with dots for nested fields
+                (e.g. 'params.train_params').
+
+        Returns:
+            The value of the field, or None if no record of `exp_id` has it.
+
+        """
+        self.sync_with_host()
+        query = self._mongoify_query({'exp_id': exp_id})
+        query[field] = {'$exists': True}
+        self._explain(self.collection, query, NEWEST_FIRST)
+        record = self.collection.find_one(query,
+                                          projection={field: True, '_id': False},
+                                          sort=NEWEST_FIRST)
+        if record is None:
+            return None
+        for key in field.split('.'):
+            record = record[key]
+        return self._de_mongoify(record)
+
+    def load_packed_tensor(self, packed, name):
+        """Load a single tensor of a packed state by reading only its bytes.
+
+        Args:
+            packed (dict): A packed state reference, e.g. the 'state' of a
+                record loaded with `get_tensors=False`.
+            name (str): Name of the tensor in the state.
+
+        Returns:
+            Tensor of arbitrary dimension.
+
+        Raises:
+            KeyError: `name` is not part of the packed state.
+
+        """
+        for entry in packed['index']:
+            if entry['name'] == name:
+                grid_out = self.filesystem.get(packed[PACKED_STATE_KEY])
+                if self._cache is not None:
+                    cached = self._cache.get(self._cache_key(
+                        grid_out._id, getattr(grid_out, 'sha1', None)))
+                    if cached is not None:
+                        return self._binary_to_tensor(cached, entry['offset'])
+                grid_out.seek(entry['offset'])
+                return self._binary_to_tensor(bytearray(grid_out.read(entry['length'])))
+        raise KeyError(name)
 
     def delete(self, object_id):
         """Delete a specific document from the collection based on the objectId.
 
-        Note that it first deletes all the gridFS files pointed to by ObjectIds
-        within the document.
+        Note that it first releases all the gridFS files pointed to by ObjectIds
+        within the document. A file is only removed once no other document
+        references it.
 
         Use with caution, clearly.
 
         Args:
             object_id: an id of an object in the database.
+
+        Raises:
+            ParamError: Delta records (see `delta_state`) are based on the
+                document; delete them first.
+
         """
+        query = {DELTA_KEY + '.base': object_id}
+        self._explain(self.collection, query)
+        dependent = self.collection.find_one(query, projection={'_id': True})
+        if dependent is not None:
+            raise ParamError('Cannot delete {}: delta record {} is based on it'
+                             .format(object_id, dependent['_id']))
         document_to_delete = self.collection.find_one({"_id": object_id})
-        # TODO: Fix _tensor_ids so that they can be removed from gridfs
-        # when the document is removed.
-        # tensors_to_delete = document_to_delete['_tensor_ids']
-        # for tensor_id in tensors_to_delete:
-            # self.filesystem.delete(tensor_id)
+        if document_to_delete is not None:
+            for tensor_id in self._collect_object_ids(document_to_delete):
+                self._release_tensor(tensor_id)
         self.collection.remove(object_id)
+        self._forget_delta_heads([object_id])
+
+    def apply_retention(self, exp_id, retention=None):
+        """Delete the checkpoints of `exp_id` that the retention policy drops.
+
+        Checkpoints are the records of `exp_id` that hold a 'state'. The
+        policy is a dict with any of the keys:
+
+            'keep_last' (int): keep the K most recent checkpoints.
+            'keep_every' (int): keep the checkpoints whose 'step' is a
+                multiple of N.
+            'keep_best' (dict): keep the 'count' (1 by default) checkpoints
+                with the lowest ('mode': 'min', the default) or highest
+                ('mode': 'max') value of the top-level field 'metric'.
+
+        A checkpoint is kept if any rule keeps it. The most recent checkpoint
+        and the base records of every kept delta record are always kept.
+
+        Args:
+            exp_id: Experiment ID whose checkpoints are pruned.
+            retention (dict, optional): Policy to apply; `self.retention` by
+                default.
+
+        Returns:
+            deleted (list): ObjectIds of the deleted records.
+
+        """
+        retention = retention or self.retention
+        if not retention:
+            return []
+        self._check_retention(retention)
+        best = retention.get('keep_best') or {}
+        fields = ['step', DELTA_KEY] + ([best['metric']] if best else [])
+        query = {'exp_id': exp_id, 'state': {'$exists': True}}
+        self._explain(self.collection, query, NEWEST_FIRST)
+        checkpoints = list(self.collection.find(query, projection=fields,
+                                                sort=NEWEST_FIRST))
+
+        keep = set(doc['_id'] for doc in
+                   checkpoints[:max(retention.get('keep_last', 0), 1)])
+        if retention.get('keep_every'):
+            keep.update(doc['_id'] for doc in checkpoints
+                        if doc.get('step') is not None and
+                        doc['step'] % retention['keep_every'] == 0)
+        if best:
+            scored = [doc for doc in checkpoints
+                      if isinstance(doc.get(best['metric']), (int, long, float))]
+            scored.sort(key=lambda doc: doc[best['metric']],
+                        reverse=best.get('mode', 'min') == 'max')
+            keep.update(doc['_id'] for doc in scored[:best.get('count', 1)])
+
+        bases = {doc['_id']: doc[DELTA_KEY]['base'] for doc in checkpoints
+                 if doc.get(DELTA_KEY) is not None}
+        for object_id in list(keep):
+            while object_id in bases and bases[object_id] not in keep:
+                object_id = bases[object_id]
+                keep.add(object_id)
+
+        deleted = [doc['_id'] for doc in checkpoints if doc['_id'] not in keep]
+        if deleted:
+            for doc in self.collection.find({'_id': {'$in': deleted}}):
+                for tensor_id in self._collect_object_ids(doc):
+                    self._release_tensor(tensor_id)
+            self.collection.delete_many({'_id': {'$in': deleted}})
+            self._forget_delta_heads(deleted)
+            log.info('Retention deleted {} checkpoints of {}'.format(len(deleted), exp_id))
+        return deleted
+
+    def collect_garbage(self, grace_seconds=3600, batch_size=1000):
+        """Delete the gridFS files that no record references.
+
+        Only files stored and last reused more than `grace_seconds` ago are
+        considered, as the records of newer files may not be written yet.
+        Their ids are looked up in the `TENSOR_IDS_KEY` index of every
+        collection of the database except gridFS's own, since other
+        interfaces may share the same gridFS. Documents written before that
+        key was introduced have no such list and are scanned for ObjectIds.
+
+        Args:
+            grace_seconds (float, optional): Minimum age of deleted files.
+            batch_size (int, optional): Number of files deleted per query.
+
+        Returns:
+            deleted (int): number of gridFS files deleted.
+
+        """
+        self.sync_with_host()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace_seconds)
+        candidates = set(doc['_id'] for doc in self.files.find(
+            {'uploadDate': {'$lt': cutoff},
+             '$or': [{'referenceDate': {'$exists': False}},
+                     {'referenceDate': {'$lt': cutoff}}]},
+            projection={'_id': True}))
+
+        for name in self.database.collection_names():
+            if not candidates:
+                break
+            if name.startswith('fs.') or name.startswith('system.'):
+                continue
+            collection = self.database[name]
+            batches = list(candidates)
+            for start in range(0, len(batches), batch_size):
+                query = {TENSOR_IDS_KEY: {'$in': batches[start:start + batch_size]}}
+                for doc in collection.find(query, projection={TENSOR_IDS_KEY: True}):
+                    candidates.difference_update(doc[TENSOR_IDS_KEY])
+            for doc in collection.find({TENSOR_IDS_KEY: {'$exists': False}}):
+                candidates.difference_update(self._collect_object_ids(doc))
+
+        candidates = list(candidates)
+        for start in range(0, len(candidates), batch_size):
+            batch = candidates[start:start + batch_size]
+            self.files.delete_many({'_id': {'$in': batch}})
+            self.chunks.delete_many({'files_id': {'$in': batch}})
+        if candidates:
+            log.info('Deleted {} unreferenced gridFS files'.format(len(candidates)))
+        return len(candidates)
+
+    def ensure_indexes(self, once=False):
+        """Create the indexes declared in `INDEXES`; existing ones are kept.
+
+        With `once`, collections whose indexes were already created through
+        the same client (see `CLIENTS`) are skipped.
+        """
+        targets = {'records': self.collection, 'metrics': self.metrics,
+                   'files': self.files}
+        for kind, indexes in INDEXES.items():
+            target = targets[kind]
+            if once and not CLIENTS.needs_indexes(self.client, self.database_name,
+                                                  target.name):
+                continue
+            for keys, options in indexes:
+                try:
+                    target.create_index(keys, **options)
+                except pm.errors.OperationFailure as e:
+                    # E.g. an index with the same keys but other options.
+                    log.warning('Could not create index {} on {}: {}'
+                                .format(keys, target.name, e))
+            CLIENTS.mark_indexed(self.client, self.database_name, target.name)
+
+    def query_plans(self):
+        """Return the explain() summaries recorded with `explain_queries`.
 
-    def sync_with_host(self, sleeptime=0):
+        Returns:
+            plans (dict): maps '<collection> <query shape> sort <sort keys>'
+                to a dict with the plan 'stages', the 'indexes' used, whether
+                it is a 'collscan', and 'docs_examined'/'returned' counts when
+                the server reports them; or to None if the query could not
+                be explained.
+
+        """
+        with self._query_plans_lock:
+            return dict(self._query_plans)
+
+    def replay_journal(self, timeout=None):
+        """Block until every journaled record has been written to the database.
+
+        Waits at most `timeout` seconds, `journal_timeout` by default.
+
+        Returns:
+            bool: False if records were still journaled after the timeout, as
+                while the database is unreachable.
+
+        """
+        if self._journal is not None:
+            return self._journal.join(self.journal_timeout if timeout is None else timeout)
+        return True
+
+    def sync_with_host(self, sleeptime=0, timeout=None):
+        """Wait for the pending writes; journaled records for at most `timeout`
+        seconds, `journal_timeout` by default, after which they are written
+        in the background."""
         time.sleep(sleeptime)
-        if len(self.checkpoint_threads) != 0:
-            for thread in self.checkpoint_threads:
-                thread.join()
-            self.checkpoint_threads = []
+        self.flush_metrics()
+        if not self.replay_journal(timeout):
+            log.warning('{} journaled records not written after {}s'.format(
+                self._journal.pending(),
+                self.journal_timeout if timeout is None else timeout))
+        if self._writer_pool is not None:
+            self._writer_pool.join()
+        with self._retention_lock:
+            pending, self._retention_results = self._retention_results, []
+        for result in pending:
+            result.wait()
 
     # Private methods ---------------------------------------------------------
-    def _save(self, document):
+    def _snapshot(self, document):
+        """Return `document` with its 'state' replaced by a Snapshot of it.
+
+        Snapshots use a free buffer if there is one and are never waited for,
+        so that a full queue is handled by the writer pool's policy.
+        """
+        if isinstance(document, list):
+            return [self._snapshot_document(doc) for doc in document]
+        return self._snapshot_document(document)
+
+    def _snapshot_document(self, doc):
+        if not isinstance(doc.get('state'), dict) or isinstance(doc['state'], Snapshot):
+            return doc
+        doc = dict(doc)
+        doc['state'] = self._snapshots.take(doc['state'], block=False)
+        return doc
+
+    def _save_snapshots(self, document):
+        """Save documents, then release the snapshots among their states."""
+        try:
+            return self._save(document)
+        finally:
+            self._release_snapshots(document)
+
+    def _journal_documents(self, document):
+        """Append documents to the journal; see `save`."""
+        if not isinstance(document, list):
+            document = [document]
+        documents = []
+        for doc in document:
+            doc = self._extract_data_from_variables(doc)
+            if 'state' in doc:
+                doc['state'] = self._move_to_cpu(doc['state'])
+            # Replaying a record twice overwrites it rather than duplicating it.
+            doc.setdefault('_id', ObjectId())
+            documents.append(doc)
+        self._journal.append((documents, datetime.datetime.now()))
+        return [doc['_id'] for doc in documents]
+
+    def _save_journaled(self, entry):
+        documents, insertion_date = entry
+        self._save(documents, insertion_date=insertion_date)
+
+    def _save(self, document, insertion_date=None):
         """Helper method that saves document in database.
 
         The collection is specified in the initialization of the object.
@@ -238,6 +1864,7 @@ class MongoInterface(DBInterface):
         Args:
             document: dictionary of arbitrary size and structure,
             can contain tensors. Can also be a list of such objects.
+            insertion_date (datetime, optional): Defaults to now.
 
         Returns:
             id_values: list of ObjectIds of the inserted object(s).
@@ -250,47 +1877,294 @@ class MongoInterface(DBInterface):
 
         object_ids = []
         for doc in document:
-            doc = self._extract_data_from_variables(doc)
-            if 'state' in doc.keys():
-                state_on_cpu = self._move_to_cpu(doc['state'])
-                doc['state'] = state_on_cpu
+            if (self.delta_state and 'state' in doc and
+                    isinstance(doc.get('exp_id'), collections.Hashable)):
+                # Each delta must be based on the record saved just before it.
+                with self._delta_lock:
+                    object_ids.append(self._save_document(doc, insertion_date))
+            else:
+                object_ids.append(self._save_document(doc, insertion_date))
 
-            doc_copy = copy.deepcopy(doc)
+        if self.retention:
+            for exp_id in set(doc['exp_id'] for doc in document
+                              if 'state' in doc and
+                              isinstance(doc.get('exp_id'), collections.Hashable)):
+                self._schedule_retention(exp_id)
 
-            # Make a list of any existing referenced gridfs files.
-            # try:
-                # self._old_tensor_ids = doc_copy['_tensor_ids']
-            # except KeyError:
-                # self._old_tensor_ids = []
+        return object_ids
 
-            # self._new_tensor_ids = []
+    def _schedule_retention(self, exp_id):
+        """Run `apply_retention` for `exp_id` on a background thread."""
+        with self._retention_lock:
+            if self._retention_pool is None:
+                self._retention_pool = ThreadPool(1)
+            self._retention_results = [result for result in self._retention_results
+                                       if not result.ready()]
+            self._retention_results.append(
+                self._retention_pool.apply_async(self._apply_retention, (exp_id,)))
+
+    def _apply_retention(self, exp_id):
+        try:
+            self.apply_retention(exp_id)
+        except pm.errors.PyMongoError as e:
+            log.warning('Retention of {} failed: {}'.format(exp_id, e))
 
-            # Replace tensors with either a new gridfs file or a reference to
-            # the old gridfs file.
-            doc_copy = self._save_tensors(doc_copy)
+    @staticmethod
+    def _check_retention(retention):
+        """Raise ParamError if `retention` is not a valid policy."""
+        if not retention:
+            return
+        unknown = set(retention) - set(['keep_last', 'keep_every', 'keep_best'])
+        if unknown:
+            raise ParamError('Unknown retention rules: {}'.format(sorted(unknown)))
+        best = retention.get('keep_best')
+        if best and ('metric' not in best or
+                     best.get('mode', 'min') not in ('min', 'max')):
+            raise ParamError("keep_best needs a 'metric' and a 'mode' of 'min' or 'max'")
+
+    def _save_document(self, doc, insertion_date=None):
+        """Save a single document; see `_save`."""
+        doc = self._extract_data_from_variables(doc)
+        if 'state' in doc.keys():
+            state_on_cpu = self._move_to_cpu(doc['state'])
+            doc['state'] = state_on_cpu
+
+        # Every step below builds new containers rather than modifying them,
+        # and tensors are read in place, so a shallow copy is enough.
+        doc_copy = dict(doc)
+
+        delta_head = None
+        if self.delta_state and 'state' in doc_copy:
+            doc_copy['state'], delta, delta_head = self._delta_state(
+                doc_copy['exp_id'], doc_copy['state'])
+            if delta is not None:
+                doc_copy[DELTA_KEY] = delta
+
+        if self.packed_state and 'state' in doc_copy:
+            doc_copy['state'] = self._pack_state(doc_copy['state'])
+
+        # Make a list of any existing referenced gridfs files.
+        # try:
+            # self._old_tensor_ids = doc_copy['_tensor_ids']
+        # except KeyError:
+            # self._old_tensor_ids = []
 
-            # doc['_tensor_ids'] = self._new_tensor_ids
-            # doc_copy['_tensor_ids'] = self._new_tensor_ids
+        # self._new_tensor_ids = []
 
-            # Cleanup any remaining gridfs files (these used to be pointed to by document, but no
-            # longer match any tensor that was in the db.
-            # for id in self._old_tensor_ids:
-                # self.filesystem.delete(id)
-            # self._old_tensor_ids = []
+        # Replace tensors with either a new gridfs file or a reference to
+        # the old gridfs file.
+        doc_copy = self._save_tensors(doc_copy)
 
-            # Add insertion date field to every document.
-            doc['insertion_date'] = datetime.datetime.now()
-            doc_copy['insertion_date'] = datetime.datetime.now()
+        # doc['_tensor_ids'] = self._new_tensor_ids
+        # doc_copy['_tensor_ids'] = self._new_tensor_ids
+        doc_copy[TENSOR_IDS_KEY] = list(set(self._collect_object_ids(doc_copy)))
 
-            # Insert into the collection and restore full data into original
-            # document object
-            doc_copy = self._mongoify(doc_copy)
+        # Cleanup any remaining gridfs files (these used to be pointed to by document, but no
+        # longer match any tensor that was in the db.
+        # for id in self._old_tensor_ids:
+            # self.filesystem.delete(id)
+        # self._old_tensor_ids = []
 
-            new_id = self.collection.save(doc_copy)
-            doc['_id'] = new_id
-            object_ids.append(new_id)
+        # Add insertion date field to every document.
+        doc['insertion_date'] = insertion_date or datetime.datetime.now()
+        doc_copy['insertion_date'] = doc['insertion_date']
 
-        return object_ids
+        # Insert into the collection and restore full data into original
+        # document object
+        doc_copy = self._mongoify(doc_copy)
+
+        # Overwriting a document releases the gridFS files it pointed to.
+        replaced = None
+        if '_id' in doc_copy:
+            replaced = self.collection.find_one({'_id': doc_copy['_id']})
+
+        new_id = self.collection.save(doc_copy)
+        if replaced is not None:
+            for tensor_id in self._collect_object_ids(replaced):
+                self._release_tensor(tensor_id)
+        if delta_head is not None:
+            delta_head['id'] = new_id
+            self._delta_heads[doc_copy['exp_id']] = delta_head
+        doc['_id'] = new_id
+        return new_id
+
+    def _delta_state(self, exp_id, state):
+        """Reduce `state` to the tensors that changed since the last save.
+
+        Tensors are compared by digest with the last state saved for `exp_id`
+        by this interface. The first state of an exp_id, and every
+        `full_state_every`-th state after it, is stored in full.
+
+        Args:
+            exp_id: exp_id of the record being saved.
+            state (dict): A PyTorch-like state_dict.
+
+        Returns:
+            tuple: The state to store, the `DELTA_KEY` entry of the record
+                (None for a full state) and the new head of the exp_id's chain.
+
+        """
+        digests = {name: self._tensor_digest(tensor) for name, tensor in state.items()}
+        head = self._delta_heads.get(exp_id)
+        if head is None or head['depth'] + 1 >= self.full_state_every:
+            return state, None, {'digests': digests, 'depth': 0}
+
+        changed = type(state)((name, tensor) for name, tensor in state.items()
+                              if head['digests'].get(name) != digests[name])
+        delta = {'base': head['id'],
+                 'depth': head['depth'] + 1,
+                 'names': list(state.keys())}
+        return changed, delta, {'digests': digests, 'depth': delta['depth']}
+
+    def _forget_delta_heads(self, object_ids):
+        """Store the next state of exp_ids whose last record was deleted in full."""
+        object_ids = set(object_ids)
+        with self._delta_lock:
+            for exp_id, head in list(self._delta_heads.items()):
+                if head.get('id') in object_ids:
+                    del self._delta_heads[exp_id]
+
+    def _tensor_digest(self, tensor):
+        """Return the SHA-1 of a tensor's kind, dtype, shape and contents."""
+        array, kind = self._as_array(tensor)
+        if array is None:
+            return hashlib.sha1(self._tensor_to_binary(tensor)).hexdigest()
+        if not array.flags.c_contiguous:
+            array = array.copy(order='C')
+        digest = hashlib.sha1('{} {} {}'.format(kind, array.dtype.str,
+                                                array.shape).encode('utf-8'))
+        digest.update(array)
+        return digest.hexdigest()
+
+    def _resolve(self, results, get_tensors, lazy):
+        """De-mongoify loaded documents and fetch or proxy their tensors."""
+        for doc in results:
+            doc.pop(TENSOR_IDS_KEY, None)
+        if get_tensors:
+            results = [self._expand_delta(doc) for doc in results]
+
+        if get_tensors and lazy:
+            all_results = [self._proxy_tensors(self._de_mongoify(doc))
+                           for doc in results]
+        elif get_tensors:
+            all_results = self._de_mongoify(self._load_tensor(results))
+        else:
+            all_results = [self._de_mongoify(doc) for doc in results]
+
+        if get_tensors:
+            all_results = [self._merge_delta(doc) for doc in all_results]
+
+        return all_results
+
+    def _explain(self, collection, query, sort=None):
+        """Record the plan of `query` if `explain_queries` is set.
+
+        Each query pattern (collection, query shape and sort) is explained
+        once; a plan that scans the whole collection is logged as a warning.
+        """
+        if not self.explain_queries:
+            return
+        pattern = '{} {} sort {}'.format(
+            collection.name, json.dumps(self._query_shape(query), sort_keys=True),
+            [key for key, _ in sort or []])
+        with self._query_plans_lock:
+            if pattern in self._query_plans:
+                return
+            self._query_plans[pattern] = None
+        try:
+            plan = self._summarize_plan(collection.find(query, sort=sort).explain())
+        except (pm.errors.PyMongoError, NotImplementedError, AttributeError) as e:
+            # AttributeError: e.g. mongomock cursors have no explain().
+            log.debug('Could not explain {}: {}'.format(pattern, e))
+            return
+        if plan['collscan']:
+            log.warning('Collection scan for query {}'.format(pattern))
+        with self._query_plans_lock:
+            self._query_plans[pattern] = plan
+
+    @staticmethod
+    def _query_shape(query):
+        """Return `query` with its values replaced by their type names."""
+        if isinstance(query, dict):
+            return {key: MongoInterface._query_shape(value)
+                    for key, value in query.items()}
+        if isinstance(query, (list, tuple)):
+            return [MongoInterface._query_shape(value) for value in query[:1]]
+        return type(query).__name__
+
+    @staticmethod
+    def _summarize_plan(explain):
+        """Extract stages, indexes and counts from an explain() result."""
+        stages, indexes = [], []
+        pending = [explain.get('queryPlanner', {}).get('winningPlan', {})]
+        while pending:
+            stage = pending.pop()
+            if 'stage' in stage:
+                stages.append(stage['stage'])
+            if 'indexName' in stage:
+                indexes.append(stage['indexName'])
+            pending.extend(stage.get('inputStages', []))
+            if 'inputStage' in stage:
+                pending.append(stage['inputStage'])
+        stats = explain.get('executionStats', {})
+        return {'stages': stages,
+                'indexes': indexes,
+                'collscan': 'COLLSCAN' in stages,
+                'docs_examined': stats.get('totalDocsExamined'),
+                'returned': stats.get('nReturned')}
+
+    @staticmethod
+    def _projection(projection):
+        """Return `projection` as a dict, keeping delta records loadable."""
+        if projection is None:
+            return None
+        if not isinstance(projection, dict):
+            projection = {field: True for field in projection}
+        projection = dict(projection)
+        inclusive = any(value for key, value in projection.items() if key != '_id')
+        if inclusive and any(key == 'state' or key.startswith('state.')
+                             for key in projection):
+            projection[DELTA_KEY] = True
+        return projection
+
+    def _expand_delta(self, document):
+        """Replace the state of a delta record with the states of its chain.
+
+        The 'state' becomes a list of the record's own state followed by the
+        states of its base records, newest first, so that `_load_tensor` can
+        fetch all of them in one pass. `_merge_delta` then combines them.
+
+        Raises:
+            LoadError: A base record of the chain no longer exists.
+
+        """
+        if DELTA_KEY not in document or 'state' not in document:
+            return document
+        states = [document['state']]
+        delta = document[DELTA_KEY]
+        while delta is not None:
+            self._explain(self.collection, {'_id': delta['base']})
+            base = self.collection.find_one({'_id': delta['base']},
+                                            projection=['state', DELTA_KEY])
+            if base is None:
+                raise LoadError('Base record {} of delta record {} is missing'
+                                .format(delta['base'], document['_id']))
+            states.append(base.get('state', {}))
+            delta = base.get(DELTA_KEY)
+        document['state'] = states
+        return document
+
+    @staticmethod
+    def _merge_delta(document):
+        """Combine the loaded states of a record expanded by `_expand_delta`."""
+        if DELTA_KEY not in document or 'state' not in document:
+            return document
+        merged = {}
+        for state in reversed(document['state']):
+            merged.update(state)
+        document['state'] = {name: merged[name]
+                             for name in document[DELTA_KEY]['names']}
+        return document
 
     def _move_to_cpu(self, state):
         """Move state to CPU.
@@ -300,38 +2174,283 @@ class MongoInterface(DBInterface):
         """
         return {n: t.cpu() for n, t in state.items()}
 
-    def _tensor_to_binary(self, tensor):
+    def _tensor_to_binary(self, tensor, name=None):
         """Utility method to turn an tensor/array into a BSON Binary string.
 
-        Called by save_tensors.
+        Joins the segments returned by `_encode_tensor`.
 
         Args:
             tensor: tensor of arbitrary dimension.
+            name (str, optional): Dotted path of the tensor in its document,
+                matched against the `codecs` rules.
 
         Returns:
-            BSON Binary object a pickled tensor.
+            BSON Binary object holding the encoded tensor.
         """
-        try:
-            return Binary(pickle.dumps(tensor.cpu(), protocol=2), subtype=128)
-        except AttributeError:
-            return Binary(pickle.dumps(tensor, protocol=2), subtype=128)
-        # return Binary(jsonpickle.encode(tensor))
-        # return jsonpickle.encode(tensor)
+        segments, subtype = self._encode_tensor(tensor, name)
+        return Binary(b''.join(segment if isinstance(segment, bytes) else segment.tobytes()
+                               for segment in segments), subtype=subtype)
+
+    def _encode_tensor(self, tensor, name=None):
+        """Encode a tensor/array without copying its data.
+
+        Called by `_put_tensor`, which streams the segments to gridFS.
+
+        The tensor is stored as `RAW_TENSOR_MAGIC`, the length of a JSON
+        header holding its kind ('numpy' or 'torch'), dtype, shape and byte
+        strides, the header itself and finally the raw contiguous bytes.
+        Tensors that numpy cannot represent (e.g. object arrays) are pickled.
+
+        If a `codecs` rule matches the tensor, its bytes are downcast and/or
+        compressed; the header then also records the 'codec', the
+        'stored_dtype' and the number of stored bytes ('nbytes').
+
+        Args:
+            tensor: tensor of arbitrary dimension.
+            name (str, optional): Dotted path of the tensor in its document,
+                matched against the `codecs` rules.
+
+        Returns:
+            tuple: The list of segments (bytes, or a numpy array sharing the
+                tensor's memory) whose concatenation is the encoded tensor,
+                and its BSON Binary subtype.
+        """
+        array, kind = self._as_array(tensor)
+        if array is None:
+            try:
+                return [pickle.dumps(tensor.cpu(), protocol=2)], PICKLED_TENSOR_SUBTYPE
+            except AttributeError:
+                return [pickle.dumps(tensor, protocol=2)], PICKLED_TENSOR_SUBTYPE
+
+        if not array.flags.c_contiguous:
+            array = array.copy(order='C')
+        header = {'kind': kind,
+                  'dtype': array.dtype.str,
+                  'shape': array.shape,
+                  'strides': array.strides}
+        data = array
+
+        rule = self._select_codec(name, array)
+        if rule is not None:
+            stored = array
+            if rule.get('downcast') == 'bfloat16':
+                stored = _to_bfloat16(array)
+                header['stored_dtype'] = 'bfloat16'
+            elif rule.get('downcast') == 'float16':
+                stored = array.astype(np.float16)
+                header['stored_dtype'] = stored.dtype.str
+            data = stored.tobytes()
+            if rule.get('codec') is not None:
+                data = _compress(rule['codec'], data, stored.dtype.itemsize,
+                                 rule['level'])
+                header['codec'] = rule['codec']
+            header['nbytes'] = len(data)
+
+        header = json.dumps(header).encode('utf-8')
+        header += b' ' * (-(_RAW_TENSOR_PREFIX.size + len(header)) % _RAW_TENSOR_ALIGNMENT)
+        return ([_RAW_TENSOR_PREFIX.pack(RAW_TENSOR_MAGIC, len(header)) + header, data],
+                RAW_TENSOR_SUBTYPE)
+
+    @staticmethod
+    def _compile_codecs(codecs):
+        """Validate `codecs` rules and compile their name patterns.
+
+        Each rule is a dict with the optional keys:
+
+            'pattern' (str): regex searched in the tensor's dotted name.
+            'min_bytes' (int): minimum size of the tensor in bytes.
+            'codec' (str): one of `TENSOR_CODECS`.
+            'level' (int): compression level (6 by default).
+            'downcast' (str): one of `TENSOR_DOWNCASTS`; only applied to
+                float32/float64 tensors.
 
-    def _binary_to_tensor(self, binary):
-        """Convert a pickled tensor string back into a tensor.
+        Raises:
+            ParamError: A rule names an unknown or unavailable codec.
+
+        """
+        rules = []
+        for rule in codecs:
+            rule = dict(rule)
+            if rule.get('codec') not in (None,) + TENSOR_CODECS:
+                raise ParamError('Unknown tensor codec {}; expected one of {}'
+                                 .format(rule['codec'], TENSOR_CODECS))
+            if rule.get('codec') == 'lzma' and lzma is None:
+                raise ParamError('The lzma codec requires lzma '
+                                 '(backports.lzma on Python 2)')
+            if rule.get('downcast') not in (None,) + TENSOR_DOWNCASTS:
+                raise ParamError('Unknown downcast {}; expected one of {}'
+                                 .format(rule['downcast'], TENSOR_DOWNCASTS))
+            rule['pattern'] = re.compile(rule.get('pattern') or '')
+            rule.setdefault('min_bytes', 0)
+            rule.setdefault('level', 6)
+            rules.append(rule)
+        return rules
+
+    def _select_codec(self, name, array):
+        """Return the first `codecs` rule matching a tensor, or None."""
+        for rule in self._codec_rules:
+            if (array.nbytes >= rule['min_bytes'] and
+                    rule['pattern'].search(name or '')):
+                if array.dtype not in (np.float32, np.float64):
+                    rule = dict(rule, downcast=None)
+                if rule.get('codec') is None and rule.get('downcast') is None:
+                    return None
+                return rule
+        return None
+
+    def _binary_to_tensor(self, binary, offset=0):
+        """Convert an encoded tensor string back into a tensor.
 
         Called by load_tensors.
 
+        Raw tensors are decoded in place: the returned array or tensor shares
+        memory with `binary`, so passing a writable buffer (see `_read_file`)
+        yields a writable tensor without any further copy. Pickled tensors
+        written by earlier versions are unpickled.
+
         Args:
-            binary: BSON Binary object a pickled tensor.
+            binary: bytes, bytearray or mmap holding an encoded tensor.
+            offset (int, optional): Position of the tensor within `binary`.
 
         Returns:
             Tensor of arbitrary dimension.
 
         """
-        return pickle.loads(binary)
-        # return jsonpickle.decode(binary)
+        magic_end = offset + len(RAW_TENSOR_MAGIC)
+        if bytearray(binary[offset:magic_end]) != RAW_TENSOR_MAGIC:
+            if offset or not isinstance(binary, bytes):
+                binary = bytes(bytearray(binary[offset:]))
+            return pickle.loads(binary)
+
+        _, header_length = _RAW_TENSOR_PREFIX.unpack_from(binary, offset)
+        header_start = offset + _RAW_TENSOR_PREFIX.size
+        data_start = header_start + header_length
+        header = json.loads(bytearray(binary[header_start:data_start]).decode('utf-8'))
+
+        dtype = np.dtype(str(header['dtype']))
+        shape = tuple(header['shape'])
+        count = int(np.prod(shape))
+        if 'nbytes' in header:
+            data = bytes(binary[data_start:data_start + header['nbytes']])
+            stored_dtype = header.get('stored_dtype', header['dtype'])
+            itemsize = 2 if stored_dtype == 'bfloat16' else np.dtype(str(stored_dtype)).itemsize
+            if 'codec' in header:
+                data = _decompress(header['codec'], data, itemsize)
+            if stored_dtype == 'bfloat16':
+                array = _from_bfloat16(np.frombuffer(data, np.uint16))
+            else:
+                array = np.frombuffer(data, np.dtype(str(stored_dtype)))
+            array = array.astype(dtype).reshape(shape)
+        elif count == 0:
+            array = np.empty(shape, dtype=dtype)
+        else:
+            array = np.frombuffer(binary, dtype=dtype, count=count,
+                                  offset=data_start).reshape(shape)
+            strides = tuple(header['strides'])
+            if array.strides != strides:
+                array = np.lib.stride_tricks.as_strided(array, shape, strides)
+
+        if header['kind'] == 'torch':
+            return torch.from_numpy(array)
+        return array
+
+    @staticmethod
+    def _as_array(tensor):
+        """Return a numpy view of `tensor` and its kind, or (None, None)."""
+        if isinstance(tensor, np.ndarray):
+            if tensor.dtype.hasobject:
+                return None, None
+            return tensor, 'numpy'
+        try:
+            return tensor.cpu().numpy(), 'torch'
+        except (AttributeError, TypeError, RuntimeError):
+            return None, None
+
+    def _pack_state(self, state):
+        """Store every tensor of `state` in one gridFS file.
+
+        Tensors are encoded with `_tensor_to_binary` and concatenated, each
+        starting on a `PACKED_ALIGNMENT` byte boundary. The returned reference
+        replaces the state in the stored record:
+
+            {PACKED_STATE_KEY: <ObjectId of the file>,
+             'index': [{'name', 'offset', 'length', 'dtype', 'shape'}, ...]}
+
+        States holding anything but tensors are returned unchanged and stored
+        tensor by tensor.
+
+        Args:
+            state (dict): A PyTorch-like state_dict.
+
+        Returns:
+            dict: The packed state reference.
+
+        """
+        if not all(isinstance(t, np.ndarray) or torch.is_tensor(t)
+                   for t in state.values()):
+            return state
+
+        index = []
+        segments = []
+        offset = 0
+        for name, tensor in state.items():
+            padding = -offset % PACKED_ALIGNMENT
+            if padding:
+                segments.append(b'\0' * padding)
+                offset += padding
+            encoded, _ = self._encode_tensor(tensor, 'state.{}'.format(name))
+            length = len(TensorStream(encoded))
+            array, _ = self._as_array(tensor)
+            index.append({'name': name,
+                          'offset': offset,
+                          'length': length,
+                          'dtype': array.dtype.str if array is not None else None,
+                          'shape': list(array.shape) if array is not None else None})
+            segments.extend(encoded)
+            offset += length
+
+        return {PACKED_STATE_KEY: self._put_stream(TensorStream(segments)),
+                'index': index}
+
+    def _unpack_state(self, packed, buffer=None):
+        """Load every tensor of a packed state with one read of its file."""
+        if not isinstance(buffer, (bytearray, mmap.mmap)):
+            buffer = self._read_file(packed[PACKED_STATE_KEY])
+        return collections.OrderedDict(
+            (entry['name'], self._binary_to_tensor(buffer, entry['offset']))
+            for entry in packed['index'])
+
+    def _read_file(self, file_id):
+        """Read a gridFS file chunk by chunk into a writable bytearray.
+
+        If a local cache is configured, a cached copy is returned as a memory
+        map instead and files read from gridFS are added to the cache.
+        """
+        grid_out = self.filesystem.get(file_id)
+        if self._cache is not None:
+            key = self._cache_key(grid_out._id, getattr(grid_out, 'sha1', None))
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+        buffer = bytearray(grid_out.length)
+        view = memoryview(buffer)
+        position = 0
+        while position < grid_out.length:
+            chunk = grid_out.readchunk()
+            if not chunk:
+                raise gridfs.errors.CorruptGridFile(
+                    'File {} ended after {} of {} bytes'
+                    .format(file_id, position, grid_out.length))
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        if self._cache is not None:
+            self._cache.put(key, buffer)
+        return buffer
+
+    @staticmethod
+    def _cache_key(file_id, sha1=None):
+        """Cache files by content hash so identical tensors share an entry."""
+        return sha1 or str(file_id)
 
     def _replace(self, document, replace='.', replacement='__'):
         """Replace `replace` in dictionary keys with `replacement`."""
@@ -436,18 +2555,20 @@ class MongoInterface(DBInterface):
         """Modify the document so that it can be stored in MongoDB.
 
         Called before saving to the database. Replaces '.' (which are rejected
-        by mongo) in keys with '__'  and serializes objects that are unserializable.
+        by mongo) in keys with '__' and '$' with a full-width dollar sign, and
+        serializes objects that are unserializable with jsonpickle, tagged as
+        ``{JSONPICKLE_TAG: <json>}`` so that `_de_mongoify` only decodes them.
 
         Args:
             document: dict to be saved in mongo
 
         """
         # for (key, value) in document.items():
-        if isinstance(value, (type, collections.Callable, Point, Polygon)):
-            return jsonpickle.encode(value)
+        if isinstance(value, _JSONPICKLED_TYPES):
+            return {JSONPICKLE_TAG: jsonpickle.encode(value)}
         elif isinstance(value, dict):
-            return {k.replace('.', '__').replace('$','____'): self._mongoify(v) for k, v in value.items()
-                    if isinstance(k, (str,unicode))}
+            return {_escape_key(k): self._mongoify(v) for k, v in value.items()
+                    if isinstance(k, (str, unicode))}
         elif isinstance(value, list):
             return [self._mongoify(v) for v in value]
         elif isinstance(value, tuple):
@@ -456,20 +2577,39 @@ class MongoInterface(DBInterface):
         else:
             return value
 
+    def _mongoify_query(self, query):
+        """Mongoify `query`, matching jsonpickled field values both tagged and
+        as the bare strings that records saved before tagging hold."""
+        mongoified = {}
+        for key, value in query.items():
+            if not isinstance(key, (str, unicode)):
+                continue
+            if isinstance(value, _JSONPICKLED_TYPES):
+                encoded = jsonpickle.encode(value)
+                mongoified[_escape_key(key)] = {'$in': [{JSONPICKLE_TAG: encoded}, encoded]}
+            else:
+                mongoified[_escape_key(key)] = self._mongoify(value)
+        return mongoified
+
     def _de_mongoify(self, value):
         if isinstance(value, dict):
-            return {k.replace('__', '.').replace('____','$'): self._de_mongoify(v) for k, v in value.items()}
+            if JSONPICKLE_TAG in value and len(value) == 1:
+                return jsonpickle.decode(value[JSONPICKLE_TAG])
+            return {_unescape_key(k): self._de_mongoify(v) for k, v in value.items()}
         elif isinstance(value, list):
             return [self._de_mongoify(v) for v in value]
         elif isinstance(value, tuple):
             return tuple(self._de_mongoify(v) for v in value)
-
-        else:
+        elif isinstance(value, basestring) and value.startswith(_LEGACY_JSONPICKLE_PREFIX):
+            # Records saved before values were tagged hold bare jsonpickle strings.
             try:
                 return jsonpickle.decode(value)
             except Exception:
                 return value
 
+        else:
+            return value
+
     def __de_mongoify(self, document):
         # untested
         for (key, value) in document.items():
@@ -515,7 +2655,7 @@ class MongoInterface(DBInterface):
                 document[key] = self._load_tensor(value)
         return document
 
-    def _save_tensors(self, value):
+    def _save_tensors(self, value, name=None):
         """Replace tensors with a reference to their location in gridFS.
 
         Utility method to recurse through a document and replace all tensors
@@ -528,21 +2668,24 @@ class MongoInterface(DBInterface):
 
         Args:
             document: dictionary like-document, storable in mongodb.
+            name (str, optional): Dotted path of `document`, used to name the
+                tensors within it for the `codecs` rules.
 
         Returns:
             document: dictionary like-document, storable in mongodb.
 
         """
         if isinstance(value, np.ndarray) or torch.is_tensor(value):
-            tensor_id = self.filesystem.put(self._tensor_to_binary(value))
+            tensor_id = self._put_tensor(value, name)
             # self._new_tensor_ids.append(tensor_id)
             return tensor_id
         elif isinstance(value, dict):
-            return {k: self._save_tensors(v) for k, v in value.items()}
+            return {k: self._save_tensors(v, k if name is None else '{}.{}'.format(name, k))
+                    for k, v in value.items()}
         elif isinstance(value, list):
-            return [self._save_tensors(v) for v in value]
+            return [self._save_tensors(v, name) for v in value]
         elif isinstance(value, tuple):
-            return tuple(self._save_tensors(v) for v in value)
+            return tuple(self._save_tensors(v, name) for v in value)
 
         elif isinstance(value, np.number):
             if isinstance(value, np.integer):
@@ -552,15 +2695,102 @@ class MongoInterface(DBInterface):
 
         return value
 
+    def _put_tensor(self, tensor, name=None):
+        """Store a tensor in gridFS and return the ObjectId of its file.
+
+        The encoded tensor is streamed to gridFS from the tensor's memory, one
+        chunk at a time (see `_put_stream`).
+
+        Args:
+            tensor: tensor/array of arbitrary dimension.
+            name (str, optional): Dotted path of the tensor in its document.
+
+        Returns:
+            ObjectId of the gridFS file holding the tensor.
+
+        """
+        segments, _ = self._encode_tensor(tensor, name)
+        return self._put_stream(TensorStream(segments))
+
+    def _put_stream(self, stream):
+        """Store a TensorStream in gridFS, reusing an identical file if any.
+
+        If `content_addressed` is set, the SHA-1 of the stream is used to find
+        an identical file that is already stored. A match has its reference
+        count incremented and is reused instead of uploading the same bytes
+        again.
+        """
+        chunk_size = self._chunk_size(len(stream))
+        if not self.content_addressed:
+            return self.filesystem.put(stream, chunk_size=chunk_size)
+
+        sha1 = stream.sha1()
+        # Files whose count already dropped to zero are being deleted.
+        # referenceDate keeps `collect_garbage` from deleting a reused file
+        # before the record that references it is written.
+        match = self.files.find_one_and_update(
+            {'sha1': sha1, 'refcount': {'$gt': 0}},
+            {'$inc': {'refcount': 1},
+             '$set': {'referenceDate': datetime.datetime.utcnow()}},
+            projection={'_id': True})
+        if match is not None:
+            return match['_id']
+        return self.filesystem.put(stream, chunk_size=chunk_size, sha1=sha1, refcount=1)
+
+    def _chunk_size(self, nbytes):
+        """Return the gridFS chunk size of a file of `nbytes` bytes.
+
+        A fixed `chunk_size` is used if one was given. Otherwise larger files
+        get larger chunks, so fewer chunk documents are inserted for them.
+        """
+        if self.chunk_size is not None:
+            return self.chunk_size
+        return min(MAX_GRIDFS_CHUNK_SIZE,
+                   max(MIN_GRIDFS_CHUNK_SIZE, nbytes // GRIDFS_CHUNKS_PER_FILE))
+
+    def _release_tensor(self, tensor_id):
+        """Drop one reference to a gridFS file, deleting it when unused.
+
+        Files stored before reference counting was introduced have no
+        `refcount` and are deleted on their first release.
+
+        Args:
+            tensor_id: ObjectId of a gridFS file. Ids that do not belong to a
+                gridFS file are ignored.
+
+        """
+        released = self.files.find_one_and_update(
+            {'_id': tensor_id},
+            {'$inc': {'refcount': -1}},
+            projection={'refcount': True},
+            return_document=pm.ReturnDocument.AFTER)
+        if released is not None and released['refcount'] <= 0:
+            self.filesystem.delete(tensor_id)
+
+    @staticmethod
+    def _collect_object_ids(value, key=None):
+        """Return every ObjectId in a stored document except its own '_id'."""
+        if isinstance(value, ObjectId):
+            return [] if key == '_id' else [value]
+        elif key == TENSOR_IDS_KEY:
+            return []
+        elif isinstance(value, dict):
+            return [oid for k, v in value.items()
+                    for oid in MongoInterface._collect_object_ids(v, k)]
+        elif isinstance(value, (list, tuple)):
+            return [oid for v in value
+                    for oid in MongoInterface._collect_object_ids(v)]
+        return []
+
     def _load_tensor(self, value):
         """Replace ObjectIds with their corresponding gridFS data.
 
-        Utility method to recurse through a document and gather all ObjectIds and
-        replace them one by one with their corresponding data from the gridFS collection.
+        Utility method to recurse through a document and gather all ObjectIds,
+        fetch the gridFS files among them in one pass (see `_fetch_files`) and
+        replace each ObjectId with its tensor.
 
-        Skips any entries with a key of '_id'.
-
-        Note that it modifies the document in place.
+        Skips any entries with a key of '_id'. ObjectIds that do not refer to
+        a gridFS file are left as they are.
 
         Args:
             document: dictionary-like document, storable in mongodb.
@@ -568,21 +2798,167 @@ class MongoInterface(DBInterface):
         Returns:
             document: dictionary-like document, storable in mongodb.
 
+        """
+        packed_ids = set(self._collect_packed_ids(value))
+        file_ids = set(self._collect_object_ids(value))
+        files = self._fetch_files(file_ids, decode=file_ids - packed_ids)
+        return self._replace_object_ids(value, files)
+
+    def _replace_object_ids(self, value, files, key=None, unpack=None):
+        """Substitute the fetched `files` for the ObjectIds in a document.
+
+        Packed states are replaced by `unpack(packed, file)`, which defaults
+        to `_unpack_state`.
         """
         if isinstance(value, ObjectId):
-            try:
-                return self._binary_to_tensor(self.filesystem.get(value).read())
-            except Exception:
-                pass
+            return value if key == '_id' else files.get(value, value)
         if isinstance(value, dict):
-            return {k: self._load_tensor(v) for k, v in value.items()}
+            if PACKED_STATE_KEY in value:
+                unpack = unpack or self._unpack_state
+                return unpack(value, files.get(value[PACKED_STATE_KEY]))
+            return {k: self._replace_object_ids(v, files, k, unpack)
+                    for k, v in value.items()}
         elif isinstance(value, list):
-            return [self._load_tensor(v) for v in value]
+            return [self._replace_object_ids(v, files, unpack=unpack) for v in value]
         elif isinstance(value, tuple):
-            return tuple(self._load_tensor(v) for v in value)
+            return tuple(self._replace_object_ids(v, files, unpack=unpack) for v in value)
 
         return value
 
+    def _proxy_tensors(self, document):
+        """Replace the gridFS ObjectIds in a document with :class:`TensorProxy`s.
+
+        Only the metadata of the referenced files is queried; tensors of a
+        packed state are proxied individually and read by byte range.
+        """
+        file_ids = list(set(self._collect_object_ids(document)))
+        proxies = {}
+        if file_ids:
+            for f in self.files.find({'_id': {'$in': file_ids}}, projection=['_id']):
+                proxies[f['_id']] = TensorProxy(partial(self._fetch_tensor, f['_id']),
+                                                f['_id'])
+
+        def proxy_packed_state(packed, _):
+            return collections.OrderedDict(
+                (entry['name'],
+                 TensorProxy(partial(self.load_packed_tensor, packed, entry['name']),
+                             packed[PACKED_STATE_KEY]))
+                for entry in packed['index'])
+
+        return self._replace_object_ids(document, proxies, unpack=proxy_packed_state)
+
+    def _fetch_tensor(self, file_id):
+        """Read and decode the tensor stored in a single gridFS file."""
+        return self._binary_to_tensor(self._read_file(file_id))
+
+    @staticmethod
+    def _collect_packed_ids(value):
+        """Return the ObjectIds of every packed state file in a document."""
+        if isinstance(value, dict):
+            if PACKED_STATE_KEY in value:
+                return [value[PACKED_STATE_KEY]]
+            return [oid for v in value.values()
+                    for oid in MongoInterface._collect_packed_ids(v)]
+        elif isinstance(value, (list, tuple)):
+            return [oid for v in value
+                    for oid in MongoInterface._collect_packed_ids(v)]
+        return []
+
+    def _fetch_files(self, file_ids, decode=()):
+        """Fetch many gridFS files at once.
+
+        A single `$in` query on the files collection finds which ids are
+        gridFS files. They are then split into `load_threads` groups of
+        similar total size. On its own thread, each group takes what it can
+        from the local cache, reads the rest with one `$in` query on the
+        chunks collection into preallocated buffers and decodes the files in
+        `decode`.
+
+        Args:
+            file_ids (iterable): ObjectIds that may refer to gridFS files.
+            decode (set): ObjectIds to decode with `_binary_to_tensor`.
+
+        Returns:
+            dict: Maps the id of every gridFS file found to its tensor (if it
+                was in `decode`) or to a buffer of its contents.
+
+        """
+        file_ids = list(file_ids)
+        if not file_ids:
+            return {}
+        self._explain(self.files, {'_id': {'$in': file_ids}})
+        files = sorted(self.files.find({'_id': {'$in': file_ids}},
+                                       projection=['length', 'chunkSize', 'sha1']),
+                       key=lambda f: f['length'], reverse=True)
+        num_groups = max(1, min(self.load_threads, len(files)))
+        groups = [[] for _ in range(num_groups)]
+        sizes = [0] * num_groups
+        for f in files:
+            smallest = sizes.index(min(sizes))
+            groups[smallest].append(f)
+            sizes[smallest] += f['length']
+
+        def fetch(group):
+            buffers = {}
+            missing = []
+            for f in group:
+                cached = (self._cache.get(self._cache_key(f['_id'], f.get('sha1')))
+                          if self._cache is not None else None)
+                if cached is None:
+                    missing.append(f)
+                else:
+                    buffers[f['_id']] = cached
+
+            downloaded = {f['_id']: bytearray(f['length']) for f in missing}
+            chunk_sizes = {f['_id']: f['chunkSize'] for f in missing}
+            received = {f['_id']: set() for f in missing}
+            if downloaded:
+                query = {'files_id': {'$in': list(downloaded)}}
+                self._explain(self.chunks, query)
+                for chunk in self.chunks.find(query):
+                    file_id = chunk['files_id']
+                    start = chunk['n'] * chunk_sizes[file_id]
+                    expected = min(chunk_sizes[file_id], len(downloaded[file_id]) - start)
+                    if expected <= 0:
+                        raise gridfs.errors.CorruptGridFile(
+                            'Extra chunk #{} of file {}'.format(chunk['n'], file_id))
+                    if len(chunk['data']) != expected:
+                        raise gridfs.errors.CorruptGridFile(
+                            'Truncated chunk #{} of file {}: expected {} bytes, got {}'
+                            .format(chunk['n'], file_id, expected, len(chunk['data'])))
+                    downloaded[file_id][start:start + expected] = chunk['data']
+                    received[file_id].add(chunk['n'])
+            for f in missing:
+                num_chunks = -(-f['length'] // f['chunkSize'])
+                if len(received[f['_id']]) != num_chunks:
+                    absent = min(set(range(num_chunks)) - received[f['_id']])
+                    raise gridfs.errors.CorruptGridFile(
+                        'No chunk #{} of file {}'.format(absent, f['_id']))
+            if self._cache is not None:
+                for f in missing:
+                    self._cache.put(self._cache_key(f['_id'], f.get('sha1')), downloaded[f['_id']])
+            buffers.update(downloaded)
+
+            fetched = {}
+            for file_id, buffer in buffers.items():
+                if file_id not in decode:
+                    fetched[file_id] = buffer
+                    continue
+                try:
+                    fetched[file_id] = self._binary_to_tensor(buffer)
+                except Exception as e:
+                    log.warning('Could not decode gridFS file {}: {}'.format(file_id, e))
+            return fetched
+
+        if num_groups == 1:
+            return fetch(groups[0])
+        if self._reader_pool is None:
+            self._reader_pool = ThreadPool(self.load_threads)
+        fetched = {}
+        for group_fetched in self._reader_pool.map(fetch, groups):
+            fetched.update(group_fetched)
+        return fetched
+
     # def __save_tensors(self, document):
     #     """Replace tensors with a reference to their location in gridFS.
 
@@ -639,3 +3015,727 @@ class MongoInterface(DBInterface):
     #                 document[key] = float(value)
 
     #     return document
+
+
+def _get_field(document, key):
+    """Return the value of a (possibly dotted) `key` of `document`.
+
+    Keys of a record may themselves contain dots (e.g. the state key
+    'linear.weight'), so the whole key is tried before its path.
+
+    Raises:
+        KeyError: The document has no such field.
+
+    """
+    if key in document:
+        return document[key]
+    head, _, rest = key.partition('.')
+    if rest and isinstance(document.get(head), dict):
+        return _get_field(document[head], rest)
+    raise KeyError(key)
+
+
+def _match_query(document, query):
+    """Return whether `document` matches a mongodb-style `query`.
+
+    Supports field equality, dotted fields, and the operators $exists, $in,
+    $nin, $ne, $gt, $gte, $lt and $lte, which cover the queries ptutils
+    issues.
+    """
+    for key, condition in query.items():
+        try:
+            value, present = _get_field(document, key), True
+        except KeyError:
+            value, present = None, False
+        if isinstance(condition, dict) and condition and all(
+                op.startswith('$') for op in condition):
+            for op, operand in condition.items():
+                if op == '$exists':
+                    matched = present == bool(operand)
+                elif op == '$in':
+                    matched = present and value in operand
+                elif op == '$nin':
+                    matched = not present or value not in operand
+                elif op == '$ne':
+                    matched = not present or value != operand
+                elif op in ('$gt', '$gte', '$lt', '$lte'):
+                    matched = present and value is not None and {
+                        '$gt': value > operand, '$gte': value >= operand,
+                        '$lt': value < operand, '$lte': value <= operand}[op]
+                else:
+                    raise ParamError('Unsupported query operator {}'.format(op))
+                if not matched:
+                    return False
+        elif not present or value != condition:
+            return False
+    return True
+
+
+def _project_fields(record, projection):
+    """Apply a mongodb-style projection, or a list of fields, to the
+    top-level fields of `record`."""
+    if not projection:
+        return record
+    if not isinstance(projection, dict):
+        projection = {field: True for field in projection}
+    fields = set(key.split('.')[0] for key in projection)
+    if any(value for key, value in projection.items() if key != '_id'):
+        keep = fields | set(['_id'] if projection.get('_id', True) else [])
+        return {k: v for k, v in record.items() if k in keep}
+    return {k: v for k, v in record.items() if k not in fields}
+
+
+class TensorFiles(object):
+    """Tensors of local records, stored as one '.npy' file each.
+
+    `save` replaces the tensors of a record by small reference dicts that
+    can be serialized with the record; `load` maps the files back with
+    np.memmap (copy-on-write), so only the pages that are used are read.
+    """
+
+    TENSOR_KEY = '__npy__'
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def save(self, value, prefix):
+        """Write the tensors in `value` to files named '<prefix>-<n>.npy'."""
+        return self._save(value, prefix, itertools.count())
+
+    def load(self, value, get_tensors=True):
+        """Replace tensor references with memory-mapped tensors or paths."""
+        if isinstance(value, dict):
+            if self.TENSOR_KEY in value:
+                path = os.path.join(self.directory, value[self.TENSOR_KEY])
+                if not get_tensors:
+                    return path
+                try:
+                    array = np.load(path, mmap_mode='c')
+                except ValueError:
+                    # Empty arrays cannot be mapped.
+                    array = np.load(path)
+                return torch.from_numpy(array) if value['torch'] else array
+            return type(value)((k, self.load(v, get_tensors))
+                               for k, v in value.items())
+        if isinstance(value, list):
+            return [self.load(v, get_tensors) for v in value]
+        if isinstance(value, tuple):
+            return tuple(self.load(v, get_tensors) for v in value)
+        return value
+
+    def delete(self, value, keep=None):
+        """Remove the files of the tensors referenced in `value`, except
+        those also referenced in `keep`."""
+        kept = set(self._paths(keep))
+        for path in self._paths(value):
+            if path in kept:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _save(self, value, prefix, counter):
+        if isinstance(value, (torch.Tensor, np.ndarray)):
+            is_torch = isinstance(value, torch.Tensor)
+            array = value.cpu().numpy() if is_torch else value
+            name = '{}-{}.npy'.format(prefix, next(counter))
+            path = os.path.join(self.directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.rename(path + '.tmp', path)
+            return {self.TENSOR_KEY: name, 'torch': is_torch}
+        if isinstance(value, dict):
+            return type(value)((k, self._save(v, prefix, counter))
+                               for k, v in value.items())
+        if isinstance(value, list):
+            return [self._save(v, prefix, counter) for v in value]
+        if isinstance(value, tuple):
+            return tuple(self._save(v, prefix, counter) for v in value)
+        return value
+
+    def _paths(self, value):
+        if isinstance(value, dict):
+            if self.TENSOR_KEY in value:
+                return [os.path.join(self.directory, value[self.TENSOR_KEY])]
+            return [path for v in value.values() for path in self._paths(v)]
+        if isinstance(value, (list, tuple)):
+            return [path for v in value for path in self._paths(v)]
+        return []
+
+
+class FileSystemInterface(DBInterface):
+    """Store experiment records in a local directory.
+
+    Records are appended as JSON lines to '<collection_name>.jsonl' in
+    `directory`; deleting a record appends a tombstone line. Tensors are
+    stored as '.npy' files under 'tensors/' and memory-mapped (copy-on-write)
+    on load (see :class:`TensorFiles`), so restoring a state reads only the
+    pages that are used.
+    """
+
+    def __init__(self, directory, collection_name='records', **kwargs):
+        super(FileSystemInterface, self).__init__(**kwargs)
+
+        self.directory = directory
+        self.collection_name = collection_name
+        self.index_path = os.path.join(directory, collection_name + '.jsonl')
+        self.tensor_directory = os.path.join(directory, 'tensors')
+        self.tensors = TensorFiles(self.tensor_directory)
+
+        # Records read from the index so far, and how far it was read.
+        self._records = collections.OrderedDict()
+        self._offset = 0
+        self._lock = threading.RLock()
+        self._exclude_from_params = ['index_path', 'tensor_directory', 'tensors',
+                                     '_records', '_offset', '_lock']
+
+    def save(self, document, multithreaded=False):
+        """Append a document, or list of documents, to the index.
+
+        Tensors are written to their own '.npy' files first, so the index
+        never refers to a missing file. Writes are synchronous;
+        `multithreaded` is accepted for compatibility with MongoInterface.
+
+        Returns:
+            id_values: list of ObjectIds of the inserted object(s).
+
+        """
+        if not isinstance(document, list):
+            document = [document]
+
+        object_ids = []
+        for doc in document:
+            doc = MongoInterface._extract_data_from_variables(doc)
+            record = dict(doc)
+            record.setdefault('_id', ObjectId())
+            record['insertion_date'] = datetime.datetime.now()
+            record = self.tensors.save(record, str(record['_id']))
+            line = jsonpickle.encode(record) + '\n'
+            with self._lock:
+                self._read_index()
+                replaced = self._records.get(record['_id'])
+                with open(self.index_path, 'ab') as f:
+                    f.write(line.encode('utf-8'))
+            if replaced is not None:
+                # Files of the same name were just rewritten.
+                self.tensors.delete(replaced, keep=record)
+            object_ids.append(record['_id'])
+        return object_ids
+
+    def load(self, query, get_tensors=True, from_load_run=False, return_all=False,
+             lazy=False, projection=None):
+        """Return the records matching `query`, most recent first.
+
+        Args:
+            query: dictionary of key-value pairs, with the query operators
+                supported by `_match_query`.
+            get_tensors (bool, optional): If False, tensors are returned as
+                the paths of their '.npy' files.
+            return_all (bool, optional): Return every match instead of only
+                the most recent one.
+            lazy (bool, optional): Accepted for compatibility with
+                MongoInterface; tensors are always memory-mapped.
+            projection (list or dict, optional): Top-level fields to return,
+                as a list of field names or a mongodb projection dict. Only
+                the files of the returned tensors are mapped.
+
+        Returns:
+            all_results: list of documents.
+
+        """
+        with self._lock:
+            self._read_index()
+            matches = [record for record in self._records.values()
+                       if _match_query(record, query)]
+        # Records appended later win ties.
+        matches = [record for _, _, record in sorted(
+            ((record['insertion_date'], i, record) for i, record in enumerate(matches)),
+            reverse=True)]
+        if not return_all:
+            matches = matches[:1]
+        return [self.tensors.load(_project_fields(record, projection), get_tensors)
+                for record in matches]
+
+    def exists(self, query):
+        with self._lock:
+            self._read_index()
+            return any(_match_query(record, query)
+                       for record in self._records.values())
+
+    def delete(self, object_id):
+        """Delete a record and the tensor files it refers to."""
+        with self._lock:
+            self._read_index()
+            record = self._records.get(object_id)
+            if record is None:
+                return
+            with open(self.index_path, 'ab') as f:
+                f.write((jsonpickle.encode({'_deleted': object_id}) + '\n').encode('utf-8'))
+        self.tensors.delete(record)
+
+    def _read_index(self):
+        """Read the lines appended to the index since the last call."""
+        try:
+            f = open(self.index_path, 'rb')
+        except IOError:
+            return
+        with f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # A record still being written.
+                    break
+                self._offset += len(line)
+                record = jsonpickle.decode(line.decode('utf-8'))
+                if '_deleted' in record:
+                    self._records.pop(record['_deleted'], None)
+                else:
+                    self._records[record['_id']] = record
+
+
+class SQLiteInterface(DBInterface):
+    """Store experiment records and metrics in an SQLite database file.
+
+    Records are kept as jsonpickle documents in a 'records' table whose
+    exp_id, step, insertion date and presence of a 'state' are indexed
+    columns; metrics go to a 'metrics' table of (exp_id, name, step, value)
+    rows. Tensors are kept in side-car '.npy' files (see :class:`TensorFiles`)
+    in `tensor_directory`, '<database_path>.tensors' by default.
+
+    The database runs in WAL mode, so readers do not block the writer.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS records ('
+        ' id TEXT PRIMARY KEY, exp_id TEXT, step INTEGER,'
+        ' insertion_date REAL, has_state INTEGER, document TEXT)',
+        'CREATE INDEX IF NOT EXISTS records_exp_id_date'
+        ' ON records (exp_id, insertion_date DESC)',
+        'CREATE INDEX IF NOT EXISTS records_exp_id_step ON records (exp_id, step)',
+        'CREATE TABLE IF NOT EXISTS metrics ('
+        ' exp_id TEXT, name TEXT, step INTEGER, value REAL)',
+        'CREATE INDEX IF NOT EXISTS metrics_exp_id_name_step'
+        ' ON metrics (exp_id, name, step)',
+    ]
+
+    def __init__(self,
+                 database_path,
+                 tensor_directory=None,
+                 metric_buffer_size=100,
+                 metric_flush_interval=5.0,
+                 **kwargs):
+        super(SQLiteInterface, self).__init__(**kwargs)
+
+        self.database_path = database_path
+        self.tensor_directory = tensor_directory or database_path + '.tensors'
+        self.tensors = TensorFiles(self.tensor_directory)
+        # Metrics are buffered and inserted in one transaction, as in
+        # MongoInterface.save_metrics.
+        self.metric_buffer_size = metric_buffer_size
+        self.metric_flush_interval = metric_flush_interval
+        self._metric_buffer = []
+        self._metric_flush_time = time.time()
+
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+        self._exit_flush = _register_exit_flush(self)
+        self._exclude_from_params = ['connection', 'tensors', '_lock',
+                                     '_metric_buffer', '_metric_flush_time',
+                                     '_exit_flush']
+
+    def save(self, document, multithreaded=False):
+        """Insert a document, or list of documents, in one transaction.
+
+        Writes are synchronous; `multithreaded` is accepted for compatibility
+        with MongoInterface.
+
+        Returns:
+            id_values: list of ObjectIds of the inserted object(s).
+
+        """
+        if not isinstance(document, list):
+            document = [document]
+
+        rows, records = [], {}
+        for doc in document:
+            record = dict(MongoInterface._extract_data_from_variables(doc))
+            record.setdefault('_id', ObjectId())
+            record['insertion_date'] = datetime.datetime.now()
+            record = self.tensors.save(record, str(record['_id']))
+            records[str(record['_id'])] = record
+            step = record.get('step')
+            rows.append((str(record['_id']),
+                         self._column_value(record.get('exp_id')),
+                         step if isinstance(step, (int, long)) else None,
+                         self._timestamp(record['insertion_date']),
+                         int('state' in record),
+                         jsonpickle.encode(record)))
+        with self._lock:
+            replaced = self.connection.execute(
+                'SELECT id, document FROM records WHERE id IN ({})'.format(
+                    ', '.join('?' * len(records))), list(records)).fetchall()
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)', rows)
+        for object_id, replaced_document in replaced:
+            # Files of the same name were just rewritten.
+            self.tensors.delete(jsonpickle.decode(replaced_document),
+                                keep=records[object_id])
+        return [ObjectId(row[0]) for row in rows]
+
+    def load(self, query, get_tensors=True, from_load_run=False, return_all=False,
+             lazy=False, projection=None):
+        """Return the records matching `query`, most recent first.
+
+        exp_id equality and {'state': {'$exists': ...}} are answered by the
+        indexed columns; any other condition is checked on the decoded
+        records with the operators supported by `_match_query`.
+
+        Args:
+            query: dictionary of key-value pairs.
+            get_tensors (bool, optional): If False, tensors are returned as
+                the paths of their '.npy' files.
+            return_all (bool, optional): Return every match instead of only
+                the most recent one.
+            lazy (bool, optional): Accepted for compatibility with
+                MongoInterface; tensors are always memory-mapped.
+            projection (list or dict, optional): Top-level fields to return,
+                as in `FileSystemInterface.load`.
+
+        Returns:
+            all_results: list of documents.
+
+        """
+        records = self._find(query, first=not return_all)
+        return [self.tensors.load(_project_fields(record, projection), get_tensors)
+                for record in records]
+
+    def exists(self, query):
+        return len(self._find(query, first=True)) > 0
+
+    def delete(self, object_id):
+        """Delete a record and the tensor files it refers to."""
+        with self._lock:
+            row = self.connection.execute('SELECT document FROM records WHERE id = ?',
+                                          (str(object_id),)).fetchone()
+            if row is None:
+                return
+            with self.connection:
+                self.connection.execute('DELETE FROM records WHERE id = ?',
+                                        (str(object_id),))
+        self.tensors.delete(jsonpickle.decode(row[0]))
+
+    def save_metrics(self, record):
+        """Buffer the scalar metrics of a record (or list of records).
+
+        See `MongoInterface.save_metrics`.
+        """
+        if not isinstance(record, list):
+            record = [record]
+
+        rows = [(self._column_value(exp_id), name, step, value)
+                for doc in record
+                for exp_id, name, step, value in _metric_points(doc)]
+
+        with self._lock:
+            self._metric_buffer.extend(rows)
+            flush = (len(self._metric_buffer) >= self.metric_buffer_size or
+                     time.time() - self._metric_flush_time >= self.metric_flush_interval)
+        if flush:
+            self.flush_metrics()
+
+    def flush_metrics(self):
+        """Insert all values buffered by `save_metrics` in one transaction."""
+        with self._lock:
+            buffered, self._metric_buffer = self._metric_buffer, []
+            self._metric_flush_time = time.time()
+            if buffered:
+                with self.connection:
+                    self.connection.executemany(
+                        'INSERT INTO metrics VALUES (?, ?, ?, ?)', buffered)
+
+    def load_metrics(self, exp_id, names=None, step_range=None):
+        """Load the time series saved with `save_metrics`.
+
+        See `MongoInterface.load_metrics`.
+        """
+        self.flush_metrics()
+        sql = 'SELECT name, step, value FROM metrics WHERE exp_id = ?'
+        args = [self._column_value(exp_id)]
+        if names is not None:
+            if isinstance(names, basestring):
+                names = [names]
+            sql += ' AND name IN ({})'.format(', '.join('?' * len(names)))
+            args.extend(names)
+        start, stop = step_range or (None, None)
+        if start is not None:
+            sql += ' AND step >= ?'
+            args.append(start)
+        if stop is not None:
+            sql += ' AND step < ?'
+            args.append(stop)
+        sql += ' ORDER BY name, step, rowid'
+
+        series = collections.OrderedDict()
+        with self._lock:
+            for name, step, value in self.connection.execute(sql, args):
+                steps, values = series.setdefault(name, ([], []))
+                steps.append(step)
+                values.append(value)
+        return {name: (np.array(steps, dtype=np.int64), np.array(values, dtype=np.float64))
+                for name, (steps, values) in series.items()}
+
+    def sync_with_host(self, sleeptime=0, timeout=None):
+        time.sleep(sleeptime)
+        self.flush_metrics()
+
+    def close(self):
+        """Write the buffered metrics and close the database connection."""
+        if self.connection is not None:
+            self.sync_with_host()
+            _unregister_exit_flush(self._exit_flush)
+            with self._lock:
+                self.connection.close()
+                self.connection = None
+
+    def _find(self, query, first=False):
+        """Return the decoded records matching `query`, newest first.
+
+        With `first`, only the most recent match is returned; if the query
+        only uses the indexed columns, only that row is read.
+        """
+        sql = 'SELECT document FROM records'
+        conditions, args = [], []
+        exp_id = query.get('exp_id')
+        if exp_id is not None and not isinstance(exp_id, dict):
+            conditions.append('exp_id = ?')
+            args.append(self._column_value(exp_id))
+        state = query.get('state')
+        if isinstance(state, dict) and list(state.keys()) == ['$exists']:
+            conditions.append('has_state = ?')
+            args.append(int(bool(state['$exists'])))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY insertion_date DESC, rowid DESC'
+        if first and len(conditions) == len(query):
+            sql += ' LIMIT 1'
+
+        with self._lock:
+            rows = self.connection.execute(sql, args).fetchall()
+        records = []
+        for (document,) in rows:
+            record = jsonpickle.decode(document)
+            if _match_query(record, query):
+                records.append(record)
+                if first:
+                    break
+        return records
+
+    @staticmethod
+    def _column_value(value):
+        """Return `value` as stored in an indexed TEXT column."""
+        return value if value is None else unicode(value)
+
+    @staticmethod
+    def _timestamp(date):
+        return time.mktime(date.timetuple()) + date.microsecond / 1e6
+
+
+# Records and metrics of every InMemoryInterface, by (database_name,
+# collection_name), so that interfaces built from the same params share data.
+_IN_MEMORY_COLLECTIONS = {}
+
+
+class InMemoryInterface(DBInterface):
+    """Keep experiment records in process memory.
+
+    Implements the query surface of :class:`MongoInterface` that ptutils
+    uses, with the query operators supported by `_match_query`, without any
+    I/O. Interfaces with the same `database_name` and `collection_name` share
+    their records, so a runner can be restored from an interface built from
+    its params.
+
+    Tensors are kept by reference unless `copy_tensors` is set: a stored
+    state then changes along with the model it was taken from.
+
+    Records stay in memory until their collection is dropped with `drop`,
+    or every collection with `clear`.
+    """
+
+    def __init__(self,
+                 database_name='ptutils',
+                 collection_name='records',
+                 copy_tensors=False,
+                 **kwargs):
+        super(InMemoryInterface, self).__init__(**kwargs)
+
+        self.database_name = database_name
+        self.collection_name = collection_name
+        self.copy_tensors = copy_tensors
+        self._collection = _IN_MEMORY_COLLECTIONS.setdefault(
+            (database_name, collection_name),
+            {'records': collections.OrderedDict(), 'metrics': {},
+             'lock': threading.RLock()})
+        self._exclude_from_params = ['_collection']
+
+    def drop(self):
+        """Delete every record and metric of this interface's collection.
+
+        Other interfaces sharing the collection see it empty too.
+        """
+        with self._collection['lock']:
+            self._collection['records'].clear()
+            self._collection['metrics'].clear()
+            _IN_MEMORY_COLLECTIONS.pop((self.database_name, self.collection_name), None)
+
+    @classmethod
+    def clear(cls):
+        """Drop the collections of every InMemoryInterface of the process."""
+        for collection in list(_IN_MEMORY_COLLECTIONS.values()):
+            with collection['lock']:
+                collection['records'].clear()
+                collection['metrics'].clear()
+        _IN_MEMORY_COLLECTIONS.clear()
+
+    def save(self, document, multithreaded=False):
+        """Store a document, or list of documents.
+
+        Returns:
+            id_values: list of ObjectIds of the inserted object(s).
+
+        """
+        if not isinstance(document, list):
+            document = [document]
+
+        object_ids = []
+        for doc in document:
+            record = self._copy(MongoInterface._extract_data_from_variables(doc),
+                                self.copy_tensors)
+            if isinstance(doc.get('state'), Snapshot) and not self.copy_tensors:
+                # The buffers of a snapshot are reused once it is released.
+                record['state'] = self._copy(record['state'], copy_tensors=True)
+            record.setdefault('_id', ObjectId())
+            record['insertion_date'] = datetime.datetime.now()
+            with self._collection['lock']:
+                records = self._collection['records']
+                records.pop(record['_id'], None)
+                records[record['_id']] = record
+            object_ids.append(record['_id'])
+        return object_ids
+
+    def load(self, query, get_tensors=True, from_load_run=False, return_all=False,
+             lazy=False, projection=None):
+        """Return the records matching `query`, most recent first.
+
+        Tensors are always returned; `get_tensors` and `lazy` are accepted
+        for compatibility with MongoInterface.
+        """
+        return list(itertools.islice(self.iter_load(query, projection=projection),
+                                     None if return_all else 1))
+
+    def iter_load(self, query, get_tensors=True, lazy=False, projection=None,
+                  batch_size=100, limit=0):
+        """Iterate over the records matching `query`, most recent first."""
+        with self._collection['lock']:
+            records = list(reversed(self._collection['records'].values()))
+        matches = (record for record in records if _match_query(record, query))
+        for record in itertools.islice(matches, limit or None):
+            yield _project_fields(self._copy(record), projection)
+
+    def load_from_ids(self, ids, get_tensors=True, lazy=False, projection=None):
+        """Load records by ObjectId (or string); None for missing ids."""
+        if type(ids) is not list:
+            ids = [ids]
+        object_ids = []
+        for object_id in ids:
+            if isinstance(object_id, basestring):
+                try:
+                    object_id = ObjectId(object_id)
+                except (TypeError, bson.errors.InvalidId):
+                    pass
+            object_ids.append(object_id)
+        with self._collection['lock']:
+            records = [self._collection['records'].get(object_id)
+                       for object_id in object_ids]
+        return [None if record is None else _project_fields(self._copy(record), projection)
+                for record in records]
+
+    def exists(self, query):
+        return len(self.load(query, projection=['_id'])) > 0
+
+    def count(self, query=None):
+        with self._collection['lock']:
+            records = list(self._collection['records'].values())
+        return sum(1 for record in records if _match_query(record, query or {}))
+
+    def latest(self, exp_id, field):
+        """Return `field` of the most recent record of `exp_id` that has it."""
+        records = self.load({'exp_id': exp_id, field: {'$exists': True}})
+        return _get_field(records[0], field) if records else None
+
+    def delete(self, object_id):
+        with self._collection['lock']:
+            self._collection['records'].pop(object_id, None)
+
+    def save_metrics(self, record):
+        """Append the scalar metrics of a record (or list of records).
+
+        See `MongoInterface.save_metrics`.
+        """
+        if not isinstance(record, list):
+            record = [record]
+        points = [point for doc in record for point in _metric_points(doc)]
+        with self._collection['lock']:
+            for exp_id, name, step, value in points:
+                self._collection['metrics'].setdefault((exp_id, name), []).append((step, value))
+
+    def load_metrics(self, exp_id, names=None, step_range=None):
+        """Load the time series saved with `save_metrics`.
+
+        See `MongoInterface.load_metrics`.
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        start, stop = step_range or (None, None)
+        metrics = {}
+        with self._collection['lock']:
+            series = [(key[1], list(points))
+                      for key, points in self._collection['metrics'].items()
+                      if key[0] == exp_id and (names is None or key[1] in names)]
+        for name, points in series:
+            points = sorted((point for point in points
+                             if (start is None or point[0] >= start) and
+                             (stop is None or point[0] < stop)),
+                            key=lambda point: point[0])
+            metrics[name] = (np.array([step for step, _ in points], dtype=np.int64),
+                             np.array([value for _, value in points], dtype=np.float64))
+        return metrics
+
+    @staticmethod
+    def _copy(value, copy_tensors=False):
+        """Copy the dicts, lists and tuples of a record, but not its leaves.
+
+        Snapshots become plain dicts, which do not hold on to their buffers.
+        """
+        if isinstance(value, dict):
+            return (dict if isinstance(value, Snapshot) else type(value))(
+                (k, InMemoryInterface._copy(v, copy_tensors)) for k, v in value.items())
+        if isinstance(value, list):
+            return [InMemoryInterface._copy(v, copy_tensors) for v in value]
+        if isinstance(value, tuple):
+            return tuple(InMemoryInterface._copy(v, copy_tensors) for v in value)
+        if copy_tensors and isinstance(value, (torch.Tensor, np.ndarray)):
+            return value.clone() if isinstance(value, torch.Tensor) else value.copy()
+        return value
+
@@ -5,6 +5,7 @@ import logging
 
 from ptutils.base import Base
 from .error import StepError, ExpIDError, LoadError
+from .snapshot import SnapshotBuffers
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -66,6 +67,11 @@ class Runner(Base):
         # global_step (int): The number of batches seen by the model during training.
         self.global_step = global_step
 
+        # CPU copies of the state that checkpoints are written from.
+        self._snapshots = SnapshotBuffers((save_params or {}).get('snapshot_buffers', 2),
+                                          (save_params or {}).get('snapshot_pin_memory', False))
+        self._exclude_from_params.append('_snapshots')
+
 # -- Runner Properties ---------------------------------------------------------
 
     @classmethod
@@ -102,6 +108,10 @@ class Runner(Base):
         # runner = Base.from_params(**params)
         runner = Base.from_params(params)
         if runner.load_params['restore']:
+            # Checkpoints journaled before a crash must reach the database first.
+            for dbinterface in (runner.dbinterface, runner.load_params['dbinterface']):
+                if not dbinterface.replay_journal():
+                    log.warning('Restoring before every journaled checkpoint was written')
             loaded_run = runner.load_run()
             loaded_params = loaded_run['params']
             loaded_state = loaded_run['state']
@@ -117,7 +127,7 @@ class Runner(Base):
             log.critical(error_msg)
             raise ExpIDError(error_msg)
 
-        if (not runner.exp_id == runner.load_params['query']['exp_id']) and len(runner.dbinterface.load({'exp_id': runner.exp_id})) > 0:
+        if (not runner.exp_id == runner.load_params['query']['exp_id']) and runner.dbinterface.exists({'exp_id': runner.exp_id}):
             # If not resuming training, exp_id must be unique
             error_msg = 'Cannot run a new experiment with same exp_id as an existing record'
             log.critical(error_msg)
@@ -186,20 +196,47 @@ class Runner(Base):
         The default behavior is to step the trainer and
         save intermediate results.
 
+        The loss is recorded every `save_params['metric_freq']` steps through
+        `dbinterface.save_metrics`, which keeps it in a time series apart from
+        the records. The state and params are saved every
+        `save_params['checkpoint_freq']` steps, which defaults to `metric_freq`.
+
+        At a checkpoint the state is copied into one of
+        `save_params['snapshot_buffers']` (2 by default) preallocated CPU
+        buffers and training resumes while `dbinterface.save_checkpoint`
+        writes it. The saved state is exactly the state after that step: a
+        buffer is not reused before its checkpoint has been written. While
+        every buffer is still being written, the state is copied into newly
+        allocated tensors rather than waited for, so a slow database only
+        delays training as far as the interface's queue policy says. With
+        `save_params['snapshot_pin_memory']` the buffers are page-locked, which
+        speeds up copies from the GPU.
+
         """
         model_output = None
+        metric_freq = self.save_params['metric_freq']
+        checkpoint_freq = self.save_params.get('checkpoint_freq') or metric_freq
         self.setup_train()
         for step in range(self.global_step, self.train_params['num_steps']):
             model_output = self.step(model_output)
-            if self.global_step % self.save_params['metric_freq'] == 0:
+            if self.global_step % metric_freq == 0:
+                self.dbinterface.save_metrics({'exp_id': self.exp_id,
+                                               'step': self.global_step,
+                                               'loss': model_output['loss'].data[0]})
+            if self.global_step % checkpoint_freq == 0:
                 # Save desired results.
                 record = {'exp_id': self.exp_id,
                           'step': self.global_step,
                           'loss': model_output['loss'].data[0],
-                          'state': self.to_state(),
                           'params': self.to_params(),
                           }
-                self.dbinterface.save(record)
+                record['state'] = self._snapshots.take(self.to_state(), block=False)
+                try:
+                    self.dbinterface.save_checkpoint(record)
+                except Exception:
+                    # Otherwise the buffer would stay reserved.
+                    record['state'].release()
+                    raise
                 log.info("Saving step {}".format(self.global_step))
 
             if self.validation_params and self.global_step % self.save_params['val_freq'] == 0:
@@ -350,7 +387,7 @@ class HyperParameterStatisticRunner(Runner):
             print(param_dict['exp_id'])
             print(param_dict['load_params']['query']['exp_id'])
 
-            if len(self.dbinterface.load({'exp_id': param_dict['exp_id']})) > 0 and self.load_params['restore'] is True:
+            if self.dbinterface.exists({'exp_id': param_dict['exp_id']}) and self.load_params['restore'] is True:
                 print(param_dict['exp_id'])
                 print(param_dict['load_params']['query']['exp_id'])
                 param_dict['load_params']['restore'] = True
@@ -0,0 +1,152 @@
+"""PTutils state snapshots.
+
+Reusable CPU copies of model states, for checkpoints that are written while
+training goes on.
+
+"""
+import threading
+import collections
+from functools import partial
+
+import numpy as np
+import torch
+
+
+class Snapshot(dict):
+    """A state whose tensors are copies held by a :class:`SnapshotBuffers`.
+
+    Maps the names of the snapshotted state to CPU copies of its tensors and
+    arrays; other values are kept as they are. The copies must not be
+    modified, and must not be used after `release`, which hands their buffers
+    back for a later snapshot.
+
+    Passing a snapshot as the 'state' of a record to `MongoInterface.save`
+    hands it over: the interface releases it once the record is written.
+    """
+
+    def __init__(self, state, release=None):
+        super(Snapshot, self).__init__(state)
+        self._release = release
+
+    @property
+    def released(self):
+        return self._release is None
+
+    def release(self):
+        """Return the buffers of this snapshot. Later calls do nothing."""
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SnapshotBuffers(object):
+    """Preallocated CPU buffers that states are copied into.
+
+    `take(state)` copies the tensors of `state` into one of `num_buffers`
+    slots and returns the copies as a :class:`Snapshot`. Each slot keeps its
+    tensors between snapshots, so once every slot has been used, a state whose
+    names, shapes and dtypes do not change is copied without allocating any
+    memory. A slot is reserved until its snapshot is released.
+
+    Args:
+        num_buffers (int): Number of slots; 2 double-buffers the state.
+        pin_memory (bool): Allocate page-locked tensors, which are copied from
+            the GPU faster. Ignored without CUDA.
+
+    """
+
+    def __init__(self, num_buffers=2, pin_memory=False):
+        self.num_buffers = max(1, num_buffers)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._slots = [{} for _ in range(self.num_buffers)]
+        self._free = collections.deque(range(self.num_buffers))
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._stats = {'snapshots': 0, 'unbuffered': 0, 'waits': 0,
+                       'allocated_bytes': 0, 'copied_bytes': 0}
+
+    def take(self, state, block=True):
+        """Copy `state` into a free slot and return the copies.
+
+        Args:
+            state: A PyTorch-like state_dict, possibly nested in dicts, lists
+                and tuples. Tensors may live on any device.
+            block (bool): Wait for a slot while every slot is reserved. If
+                False, the state is copied into newly allocated tensors
+                instead.
+
+        Returns:
+            Snapshot: The copied state.
+
+        """
+        with self._lock:
+            if not self._free and block:
+                self._stats['waits'] += 1
+                while not self._free:
+                    self._released.wait()
+            index = self._free.popleft() if self._free else None
+            self._stats['snapshots' if index is not None else 'unbuffered'] += 1
+
+        if index is None:
+            return Snapshot(self._copy(state, {}, ()))
+        try:
+            copies = self._copy(state, self._slots[index], ())
+        except Exception:
+            self._release(index)
+            raise
+        return Snapshot(copies, partial(self._release, index))
+
+    def stats(self):
+        """Return counters of snapshots, waits and allocated and copied bytes."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['free'] = len(self._free)
+        return stats
+
+    def _release(self, index):
+        with self._lock:
+            self._free.append(index)
+            self._released.notify()
+
+    def _copy(self, value, slot, path):
+        """Copy the tensors within `value` into the buffers of `slot`."""
+        if torch.is_tensor(value):
+            value = value.detach()
+            buffer = slot.get(path)
+            if (not torch.is_tensor(buffer) or buffer.size() != value.size() or
+                    buffer.dtype != value.dtype):
+                buffer = torch.empty(value.size(), dtype=value.dtype,
+                                     pin_memory=self.pin_memory)
+                slot[path] = buffer
+                self._count('allocated_bytes', buffer.numel() * buffer.element_size())
+            buffer.copy_(value)
+            self._count('copied_bytes', buffer.numel() * buffer.element_size())
+            return buffer
+        elif isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            buffer = slot.get(path)
+            if (not isinstance(buffer, np.ndarray) or buffer.shape != value.shape or
+                    buffer.dtype != value.dtype):
+                buffer = np.empty_like(value, order='C')
+                slot[path] = buffer
+                self._count('allocated_bytes', buffer.nbytes)
+            np.copyto(buffer, value)
+            self._count('copied_bytes', buffer.nbytes)
+            return buffer
+        elif isinstance(value, dict):
+            return type(value)((k, self._copy(v, slot, path + (k,)))
+                               for k, v in value.items())
+        elif isinstance(value, list):
+            return [self._copy(v, slot, path + (i,)) for i, v in enumerate(value)]
+        elif isinstance(value, tuple):
+            return tuple(self._copy(v, slot, path + (i,)) for i, v in enumerate(value))
+        return value
+
+    def _count(self, name, nbytes):
+        with self._lock:
+            self._stats[name] += nbytes
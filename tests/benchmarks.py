@@ -0,0 +1,131 @@
+"""ptutils database benchmarks.
+
+These benchmarks time :class:`ptutils.database.MongoInterface` operations and
+print one table per benchmark. Run them directly:
+
+    python benchmarks.py
+
+Note about MongoDB:
+The benchmarks require a MongoDB instance to be available on MONGO_PORT, just
+like the tests in test.py. The benchmark database is dropped afterwards.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import sys
+import time
+import pymongo
+
+import torch
+import jsonpickle
+
+sys.path.insert(0, '../')
+from ptutils import database
+
+MONGO_PORT = 27017
+MONGO_HOST = 'localhost'
+DATABASE_NAME = 'ptutils-benchmark'
+COLLECTION_NAME = 'benchmark'
+
+
+def timed(func, repeat=3):
+    """Return the best wall time of `repeat` calls to `func`, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        best = min(best, time.time() - start)
+    return best
+
+
+def make_state(num_tensors, tensor_size):
+    return {'layer{}.weight'.format(i): torch.randn(tensor_size)
+            for i in range(num_tensors)}
+
+
+def benchmark_restore(tensor_counts=(10, 100, 1000), tensor_size=1024):
+    """Restore time of a saved state as a function of its number of tensors.
+
+    'serial' reads the files one `filesystem.get` at a time, as `load` used to;
+    the other columns use `load` with the given number of `load_threads`.
+    """
+    thread_counts = (1, 4, 16)
+    print('restore: seconds to load a state of N tensors of {} floats'.format(tensor_size))
+    print('{:>8} {:>10}'.format('N', 'serial') +
+          ''.join('{:>10}'.format('{} thr'.format(n)) for n in thread_counts))
+
+    for num_tensors in tensor_counts:
+        exp_id = 'benchmark_restore_{}'.format(num_tensors)
+        dbinterface = database.MongoInterface(DATABASE_NAME, COLLECTION_NAME,
+                                              MONGO_HOST, MONGO_PORT)
+        dbinterface.save({'exp_id': exp_id, 'state': make_state(num_tensors, tensor_size)},
+                         multithreaded=False)
+
+        stored = dbinterface.load({'exp_id': exp_id}, get_tensors=False)[0]['state']
+
+        def load_serially():
+            return {name: dbinterface._binary_to_tensor(
+                dbinterface.filesystem.get(file_id).read())
+                for name, file_id in stored.items()}
+
+        row = [timed(load_serially)]
+        for load_threads in thread_counts:
+            dbinterface.load_threads = load_threads
+            dbinterface._reader_pool = None
+            row.append(timed(lambda: dbinterface.load({'exp_id': exp_id})))
+        print('{:>8} '.format(num_tensors) + ''.join('{:>10.4f}'.format(t) for t in row))
+
+
+def legacy_de_mongoify(value):
+    """`MongoInterface._de_mongoify` before jsonpickled values were tagged."""
+    if isinstance(value, dict):
+        return {k.replace('__', '.').replace('____', '$'): legacy_de_mongoify(v)
+                for k, v in value.items()}
+    elif isinstance(value, list):
+        return [legacy_de_mongoify(v) for v in value]
+    try:
+        return jsonpickle.decode(value)
+    except Exception:
+        return value
+
+
+def make_params(num_leaves):
+    return {'layer{}'.format(i): {'func': torch.nn.Linear,
+                                  'in_features': i,
+                                  'name': 'layer.{}'.format(i),
+                                  'bias': True,
+                                  'lr': 0.1}
+            for i in range(num_leaves // 5)}
+
+
+def benchmark_de_mongoify(leaf_counts=(100, 1000, 10000)):
+    """CPU time of decoding a loaded params tree as a function of its size.
+
+    'legacy' tries jsonpickle.decode on every leaf, as `_de_mongoify` used
+    to; 'tagged' is the current `_de_mongoify`.
+    """
+    dbinterface = database.MongoInterface(DATABASE_NAME, COLLECTION_NAME,
+                                          MONGO_HOST, MONGO_PORT)
+    print('de_mongoify: seconds to decode a params tree of N leaves')
+    print('{:>8} {:>10} {:>10}'.format('N', 'legacy', 'tagged'))
+    for num_leaves in leaf_counts:
+        params = make_params(num_leaves)
+        legacy = dbinterface._mongoify(params)
+        for layer in legacy.values():
+            layer['func'] = layer['func'][database.JSONPICKLE_TAG]
+        tagged = dbinterface._mongoify(params)
+        row = [timed(lambda: legacy_de_mongoify(legacy)),
+               timed(lambda: dbinterface._de_mongoify(tagged))]
+        print('{:>8} '.format(num_leaves) + ''.join('{:>10.4f}'.format(t) for t in row))
+
+
+BENCHMARKS = [benchmark_restore, benchmark_de_mongoify]
+
+
+if __name__ == '__main__':
+    try:
+        for benchmark in BENCHMARKS:
+            benchmark()
+            print()
+    finally:
+        pymongo.MongoClient(MONGO_HOST, MONGO_PORT).drop_database(DATABASE_NAME)
@@ -19,17 +19,24 @@ import re
 import sys
 import time
 import errno
+import zlib
+import atexit
 import shutil
+import hashlib
+import pickle
 import logging
+import threading
+import gridfs
 import pymongo
 import unittest
 import numpy as np
+from bson.binary import Binary
 from bson.objectid import ObjectId
 
 import torch
 
 sys.path.insert(0, '../')
-from ptutils import base, data, error, model, runner, database
+from ptutils import base, data, error, model, runner, database, snapshot
 
 LOG_LEVEL = 'WARNING'
 MONGO_PORT = 27017
@@ -42,7 +49,7 @@ def setUpModule():
 
 def tearDownModule():
     """Tear down module after all TestCases are run."""
-    pass
+    database.InMemoryInterface.clear()
 
 
 class TestBase(unittest.TestCase):
@@ -685,6 +692,1074 @@ class TestMongoInterface(Test):
             {'exp_id': 'test_delete'})
         self.assertEqual(r.count(), 0)
 
+    def test_save_reuses_identical_tensors(self):
+        tensor = torch.Tensor([4, 5, 6])
+        doc = {'exp_id': 'test_save_reuses_identical_tensors', 'tensor': tensor}
+        first = self.dbinterface.save(doc, multithreaded=False)
+        second = self.dbinterface.save(doc, multithreaded=False)
+        first_doc = self.dbinterface.collection.find_one({'_id': first[0]})
+        second_doc = self.dbinterface.collection.find_one({'_id': second[0]})
+        tensor_id = first_doc['tensor']
+        self.assertEqual(tensor_id, second_doc['tensor'])
+        self.assertEqual(self.dbinterface.files.find_one({'_id': tensor_id})['refcount'], 2)
+
+        self.dbinterface.delete(first[0])
+        self.assertTrue(self.dbinterface.filesystem.exists(tensor_id))
+        self.dbinterface.delete(second[0])
+        self.assertFalse(self.dbinterface.filesystem.exists(tensor_id))
+
+    def test_save_raw_tensor_encoding(self):
+        tensor = torch.arange(6).view(2, 3).t()
+        doc = {'exp_id': 'test_save_raw_tensor_encoding', 'tensor': tensor}
+        object_id = self.dbinterface.save(doc, multithreaded=False)[0]
+        tensor_id = self.dbinterface.collection.find_one({'_id': object_id})['tensor']
+        data = self.dbinterface.filesystem.get(tensor_id).read()
+        self.assertTrue(data.startswith(database.RAW_TENSOR_MAGIC))
+        r = self.dbinterface.load({'exp_id': 'test_save_raw_tensor_encoding'})
+        self.assertTrue(torch.equal(tensor, r[0]['tensor']))
+
+    def test_save_streamed(self):
+        tensor = torch.randn(2 ** 20)
+        doc = {'exp_id': 'test_save_streamed', 'tensor': tensor}
+        object_id = self.dbinterface.save(doc, multithreaded=False)[0]
+        tensor_id = self.dbinterface.collection.find_one({'_id': object_id})['tensor']
+        stored = self.dbinterface.files.find_one({'_id': tensor_id})
+        self.assertEqual(stored['chunkSize'],
+                         stored['length'] // database.GRIDFS_CHUNKS_PER_FILE)
+        self.assertGreater(stored['chunkSize'], database.MIN_GRIDFS_CHUNK_SIZE)
+        self.assertEqual(stored['sha1'], hashlib.sha1(
+            self.dbinterface._tensor_to_binary(tensor)).hexdigest())
+        r = self.dbinterface.load({'exp_id': 'test_save_streamed'})
+        self.assertTrue(torch.equal(tensor, r[0]['tensor']))
+
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              chunk_size=1000)
+        tensor_id = dbinterface._put_tensor(torch.randn(3000))
+        self.assertEqual(dbinterface.files.find_one({'_id': tensor_id})['chunkSize'], 1000)
+        self.assertEqual(dbinterface.chunks.find({'files_id': tensor_id}).count(), 13)
+
+        stream = database.TensorStream([b'head', np.arange(3, dtype=np.uint8), b''])
+        self.assertEqual(len(stream), 7)
+        self.assertEqual([stream.read(3), stream.read(3), stream.read()],
+                         [b'hea', b'd\x00\x01', b'\x02'])
+
+    def test_load_pickled_tensor(self):
+        tensor = torch.Tensor([1, 2, 3])
+        tensor_id = self.dbinterface.filesystem.put(
+            pickle.dumps(tensor, protocol=2))
+        self.dbinterface.collection.insert_one(
+            {'exp_id': 'test_load_pickled_tensor', 'tensor': tensor_id})
+        r = self.dbinterface.load({'exp_id': 'test_load_pickled_tensor'})
+        self.assertTrue(torch.equal(tensor, r[0]['tensor']))
+
+    def test_load_packed_state(self):
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              packed_state=True)
+        b = base.Base()
+        b.linear = torch.nn.Linear(3, 2)
+        b.norm = torch.nn.BatchNorm1d(2)
+        state = b.to_state()
+        doc = {'exp_id': 'test_load_packed_state', 'state': state}
+        dbinterface.save(doc, multithreaded=False)
+
+        stored = dbinterface.load({'exp_id': 'test_load_packed_state'},
+                                  get_tensors=False)[0]['state']
+        self.assertIsInstance(stored[database.PACKED_STATE_KEY], ObjectId)
+        self.assertTrue(torch.equal(
+            state['linear.weight'],
+            dbinterface.load_packed_tensor(stored, 'linear.weight')))
+
+        restored_state = dbinterface.load({'exp_id': 'test_load_packed_state'})[0]['state']
+        self.assertItemsEqual(state.keys(), restored_state.keys())
+        for name in state:
+            self.assertTrue(torch.equal(state[name], restored_state[name]))
+
+    def test_load_many_tensors(self):
+        tensors = {'t{}'.format(i): torch.randn(i + 1) for i in range(10)}
+        reference = ObjectId()
+        doc = {'exp_id': 'test_load_many_tensors', 'tensors': tensors,
+               'reference': reference}
+        self.dbinterface.save(doc, multithreaded=False)
+        r = self.dbinterface.load({'exp_id': 'test_load_many_tensors'})[0]
+        self.assertEqual(r['reference'], reference)
+        for name, tensor in tensors.items():
+            self.assertTrue(torch.equal(tensor, r['tensors'][name]))
+
+    def test_load_corrupt_file(self):
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              chunk_size=1000)
+        exp_id = 'test_load_corrupt_file'
+        object_id = dbinterface.save({'exp_id': exp_id, 'tensor': torch.randn(1000)},
+                                     multithreaded=False)[0]
+        tensor_id = dbinterface.collection.find_one({'_id': object_id})['tensor']
+        dbinterface.chunks.update_one({'files_id': tensor_id, 'n': 1},
+                                      {'$set': {'data': Binary(b'short')}})
+        with self.assertRaises(gridfs.errors.CorruptGridFile):
+            dbinterface.load({'exp_id': exp_id})
+        dbinterface.chunks.delete_one({'files_id': tensor_id, 'n': 1})
+        with self.assertRaises(gridfs.errors.CorruptGridFile):
+            dbinterface.load({'exp_id': exp_id})
+
+    def test_load_lazy(self):
+        tensor = torch.Tensor([1, 2, 3])
+        doc = {'exp_id': 'test_load_lazy', 'step': 3, 'tensor': tensor}
+        self.dbinterface.save(doc, multithreaded=False)
+        r = self.dbinterface.load({'exp_id': 'test_load_lazy'}, lazy=True)[0]
+        self.assertEqual(r['step'], 3)
+        self.assertIsInstance(r['tensor'], database.TensorProxy)
+        self.assertFalse(r['tensor'].materialized)
+        self.assertEqual(r['tensor'].size(), tensor.size())
+        self.assertTrue(r['tensor'].materialized)
+        self.assertTrue(torch.equal(tensor, r['tensor'].materialize()))
+        self.assertTrue(torch.equal(tensor, database.materialize(r)['tensor']))
+
+    def test_load_cached(self):
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              cache_dir=self.cache_dir)
+        self.addCleanup(self.remove_directory, self.cache_dir)
+        tensor = torch.Tensor([7, 8, 9])
+        doc = {'exp_id': 'test_load_cached', 'tensor': tensor}
+        dbinterface.save(doc, multithreaded=False)
+        for _ in range(2):
+            r = dbinterface.load({'exp_id': 'test_load_cached'})
+            self.assertTrue(torch.equal(tensor, r[0]['tensor']))
+        stats = dbinterface.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_load_delta_state(self):
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              delta_state=True,
+                                              full_state_every=3)
+        b = base.Base()
+        b.linear = torch.nn.Linear(2, 2)
+        exp_id = 'test_load_delta_state'
+        depths = []
+        biases = []
+        for step in range(4):
+            b.linear.bias.data.add_(1)
+            biases.append(b.linear.bias.data.clone())
+            object_id = dbinterface.save({'exp_id': exp_id, 'step': step,
+                                          'state': b.to_state()},
+                                         multithreaded=False)[0]
+            record = dbinterface.collection.find_one({'_id': object_id})
+            depths.append(record.get(database.DELTA_KEY, {}).get('depth', 0))
+            if step == 1:
+                self.assertEqual(list(record['state'].keys()), ['linear__bias'])
+
+        self.assertEqual(depths, [0, 1, 2, 0])
+        r = dbinterface.load({'exp_id': exp_id, 'step': 2})[0]
+        restored_state = r['state']
+        self.assertItemsEqual(b.to_state().keys(), restored_state.keys())
+        self.assertTrue(torch.equal(b.linear.weight.data, restored_state['linear.weight']))
+        self.assertTrue(torch.equal(biases[2], restored_state['linear.bias']))
+
+    def test_delete_delta_base(self):
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              delta_state=True)
+        exp_id = 'test_delete_delta_base'
+        object_ids = [dbinterface.save({'exp_id': exp_id, 'step': step,
+                                        'state': {'weight': torch.ones(2) * step}},
+                                       multithreaded=False)[0]
+                      for step in range(2)]
+        with self.assertRaises(error.ParamError):
+            dbinterface.delete(object_ids[0])
+        self.assertEqual(dbinterface.load({'exp_id': exp_id, 'step': 1})[0]['step'], 1)
+
+        dbinterface.delete(object_ids[1])
+        dbinterface.delete(object_ids[0])
+        # The next state is not based on a deleted record.
+        object_id = dbinterface.save({'exp_id': exp_id, 'step': 2,
+                                      'state': {'weight': torch.ones(2)}},
+                                     multithreaded=False)[0]
+        self.assertNotIn(database.DELTA_KEY, dbinterface.collection.find_one({'_id': object_id}))
+
+    def test_load_compressed_state(self):
+        codecs = [{'pattern': r'weight$', 'codec': 'shuffle_zlib'},
+                  {'pattern': r'bias$', 'codec': 'zlib', 'downcast': 'bfloat16'}]
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              codecs=codecs)
+        b = base.Base()
+        b.linear = torch.nn.Linear(16, 16)
+        state = b.to_state()
+        doc = {'exp_id': 'test_load_compressed_state', 'state': state}
+        dbinterface.save(doc, multithreaded=False)
+        restored_state = dbinterface.load({'exp_id': 'test_load_compressed_state'})[0]['state']
+        self.assertTrue(torch.equal(state['linear.weight'], restored_state['linear.weight']))
+        self.assertEqual(restored_state['linear.bias'].dtype, torch.float32)
+        self.assertTrue(np.allclose(state['linear.bias'].numpy(),
+                                    restored_state['linear.bias'].numpy(),
+                                    rtol=1e-2))
+
+        with self.assertRaises(error.ParamError):
+            database.MongoInterface(self.database_name, self.collection_name,
+                                    self.host, self.port, codecs=[{'codec': 'gzip'}])
+
+    def test_save_multithreaded(self):
+        for step in range(3):
+            self.dbinterface.save({'exp_id': 'test_save_multithreaded', 'step': step})
+        self.dbinterface.sync_with_host()
+        r = self.conn[self.database_name][self.collection_name].find(
+            {'exp_id': 'test_save_multithreaded'})
+        self.assertEqual(r.count(), 3)
+        self.assertEqual(self.dbinterface.checkpoint_stats()['written'], 3)
+
+    def test_save_multithreaded_snapshot(self):
+        weight = torch.zeros(8)
+        for step in range(3):
+            weight.fill_(step)
+            self.dbinterface.save({'exp_id': 'test_save_multithreaded_snapshot',
+                                   'step': step, 'state': {'weight': weight}})
+        weight.fill_(-1)
+        self.dbinterface.sync_with_host()
+        for record in self.dbinterface.load({'exp_id': 'test_save_multithreaded_snapshot'}):
+            self.assertTrue(torch.equal(record['state']['weight'],
+                                        torch.full((8,), record['step'])))
+        stats = self.dbinterface._snapshots.stats()
+        self.assertEqual(stats['free'], 2)
+        self.assertEqual(stats['waits'], 0)
+        # Each buffer is allocated once; saves finding none free allocate a copy.
+        self.assertEqual(stats['allocated_bytes'],
+                         min(stats['snapshots'], 2) * weight.numel() * weight.element_size() +
+                         stats['unbuffered'] * weight.numel() * weight.element_size())
+
+        # Snapshots taken by the caller are written without another copy.
+        buffers = snapshot.SnapshotBuffers(num_buffers=1)
+        state = buffers.take({'weight': weight})
+        self.dbinterface.save_checkpoint({'exp_id': 'test_save_multithreaded_snapshot',
+                                          'step': 3, 'state': state})
+        self.dbinterface.sync_with_host()
+        self.assertTrue(state.released)
+        self.assertEqual(self.dbinterface._snapshots.stats()['snapshots'], stats['snapshots'])
+
+    def test_save_multithreaded_snapshot_list(self):
+        exp_id = 'test_save_multithreaded_snapshot_list'
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              snapshot_buffers=2,
+                                              snapshot_pin_memory=True)
+        self.assertTrue(dbinterface.to_params()['snapshot_pin_memory'])
+        dbinterface.save([{'exp_id': exp_id, 'step': step,
+                           'state': {'weight': torch.ones(2) * step}}
+                          for step in range(3)])
+        dbinterface.sync_with_host()
+        # Only the document beyond the number of buffers is copied unbuffered.
+        stats = dbinterface._snapshots.stats()
+        self.assertEqual((stats['snapshots'], stats['unbuffered'], stats['free']), (2, 1, 2))
+        for record in dbinterface.load({'exp_id': exp_id}, return_all=True):
+            self.assertTrue(torch.equal(record['state']['weight'],
+                                        torch.ones(2) * record['step']))
+
+    def test_save_multithreaded_coalesce_does_not_block(self):
+        exp_id = 'test_save_multithreaded_coalesce_does_not_block'
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              writer_threads=1,
+                                              max_queued_writes=1,
+                                              queue_policy='coalesce',
+                                              snapshot_buffers=1)
+        save = dbinterface._save
+
+        def slow_save(document):
+            time.sleep(0.2)
+            return save(document)
+
+        dbinterface._save = slow_save
+        start = time.time()
+        for step in range(4):
+            dbinterface.save({'exp_id': exp_id, 'step': step,
+                              'state': {'weight': torch.ones(2) * step}})
+        self.assertLess(time.time() - start, 0.2)
+        dbinterface.sync_with_host()
+        self.assertEqual(dbinterface._snapshots.stats()['waits'], 0)
+        self.assertGreater(dbinterface.checkpoint_stats()['coalesced'], 0)
+        self.assertEqual(dbinterface._snapshots.stats()['free'], 1)
+        self.assertEqual(dbinterface.load({'exp_id': exp_id})[0]['step'], 3)
+
+    def test_mongoify(self):
+        document = {'func': base.Base, 'a.b': {'$c': 1}, 'name': '{"py/not-json',
+                    'legacy': '{"py/type": "ptutils.base.Base"}'}
+        stored = self.dbinterface._mongoify(document)
+        self.assertEqual(stored['func'], {database.JSONPICKLE_TAG: '{"py/type": "ptutils.base.Base"}'})
+        self.assertEqual(stored['a__b'], {u'\uff04c': 1})
+        self.assertEqual(self.dbinterface._de_mongoify(stored),
+                         dict(document, legacy=base.Base))
+
+    def test_mongoify_keys(self):
+        document = {'a..b': 1, 'a$.b': 2, '$a': {'c.d': 3}}
+        self.assertEqual(self.dbinterface._de_mongoify(self.dbinterface._mongoify(document)),
+                         document)
+        # Older records stored '$' as '____', which was always read as '..'.
+        self.assertEqual(self.dbinterface._de_mongoify({'a____b': 1}), {'a..b': 1})
+        exp_id = 'test_mongoify_keys'
+        self.dbinterface.save(dict(document, exp_id=exp_id), multithreaded=False)
+        r = self.dbinterface.load({'exp_id': exp_id})[0]
+        self.assertEqual({key: r[key] for key in document}, document)
+
+    def test_query_jsonpickled(self):
+        exp_id = 'test_query_jsonpickled'
+        self.dbinterface.save({'exp_id': exp_id, 'step': 1, 'func': base.Base})
+        # Records saved before values were tagged hold bare jsonpickle strings.
+        self.dbinterface.collection.insert_one({'exp_id': exp_id, 'step': 0,
+                                                'func': '{"py/type": "ptutils.base.Base"}'})
+        self.dbinterface.save({'exp_id': exp_id, 'step': 2, 'func': runner.Runner})
+        query = {'exp_id': exp_id, 'func': base.Base}
+        self.assertEqual(self.dbinterface.count(query), 2)
+        self.assertItemsEqual([r['step'] for r in self.dbinterface.iter_load(query)], [0, 1])
+        for r in self.dbinterface.load(query, return_all=True):
+            self.assertIs(r['func'], base.Base)
+
+    def test_load_projection(self):
+        exp_id = 'test_load_projection'
+        for step in range(2):
+            self.dbinterface.save({'exp_id': exp_id, 'step': step,
+                                   'params': {'lr': 0.1 * (step + 1)},
+                                   'tensor': torch.Tensor([step])},
+                                  multithreaded=False)
+        r = self.dbinterface.load({'exp_id': exp_id}, projection=['step'])[0]
+        self.assertItemsEqual(r.keys(), ['_id', 'step'])
+
+        self.assertTrue(self.dbinterface.exists({'exp_id': exp_id}))
+        self.assertFalse(self.dbinterface.exists({'exp_id': exp_id + '_missing'}))
+        self.assertEqual(self.dbinterface.count({'exp_id': exp_id}), 2)
+        self.assertEqual(self.dbinterface.latest(exp_id, 'params.lr'), 0.2)
+        self.assertIsInstance(self.dbinterface.latest(exp_id, 'tensor'), ObjectId)
+        self.assertIsNone(self.dbinterface.latest(exp_id, 'loss'))
+
+    def test_iter_load(self):
+        exp_id = 'test_iter_load'
+        tensors = [torch.Tensor([step]) for step in range(5)]
+        for step, tensor in enumerate(tensors):
+            self.dbinterface.save({'exp_id': exp_id, 'step': step, 'tensor': tensor},
+                                  multithreaded=False)
+        results = list(self.dbinterface.iter_load({'exp_id': exp_id}, batch_size=2))
+        self.assertItemsEqual([r['step'] for r in results], range(5))
+        for r in results:
+            self.assertTrue(torch.equal(tensors[r['step']], r['tensor']))
+
+        records = self.dbinterface.iter_load({'exp_id': exp_id}, get_tensors=False,
+                                             batch_size=2)
+        self.assertIsInstance(next(records)['tensor'], ObjectId)
+        records.close()
+        self.assertEqual(len(list(self.dbinterface.iter_load({'exp_id': exp_id},
+                                                             limit=3))), 3)
+
+    def test_load_from_ids(self):
+        tensors = [torch.Tensor([step]) for step in range(3)]
+        object_ids = [self.dbinterface.save({'exp_id': 'test_load_from_ids',
+                                             'step': step, 'tensor': tensor},
+                                            multithreaded=False)[0]
+                      for step, tensor in enumerate(tensors)]
+        ids = [object_ids[2], ObjectId(), str(object_ids[0]), object_ids[1]]
+        r = self.dbinterface.load_from_ids(ids)
+        self.assertEqual([doc and doc['step'] for doc in r], [2, None, 0, 1])
+        self.assertTrue(torch.equal(tensors[2], r[0]['tensor']))
+        self.assertEqual(self.dbinterface.load_from_ids(object_ids[1])[0]['step'], 1)
+        r = self.dbinterface.load_from_ids(object_ids[::-1], projection={'_id': False,
+                                                                         'tensor': False})
+        self.assertEqual(r, [{'exp_id': 'test_load_from_ids', 'step': step,
+                              'insertion_date': doc['insertion_date']}
+                             for step, doc in zip([2, 1, 0], r)])
+        r = self.dbinterface.load_from_ids(object_ids, projection={'_id': False})
+        self.assertEqual([doc['step'] for doc in r], [0, 1, 2])
+        self.assertNotIn('_id', r[0])
+
+    def test_retention(self):
+        retention = {'keep_last': 2, 'keep_every': 4,
+                     'keep_best': {'metric': 'loss', 'mode': 'min'}}
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              retention=retention)
+        exp_id = 'test_retention'
+        num_files = dbinterface.files.count()
+        losses = [5, 1, 4, 3, 6, 7, 8, 9, 2]
+        for step, loss in enumerate(losses):
+            dbinterface.save({'exp_id': exp_id, 'step': step, 'loss': loss,
+                              'state': {'weight': torch.randn(4)}},
+                             multithreaded=False)
+        dbinterface.sync_with_host()
+        kept = [r['step'] for r in dbinterface.load({'exp_id': exp_id}, return_all=True,
+                                                    get_tensors=False)]
+        self.assertItemsEqual(kept, [0, 1, 4, 7, 8])
+        self.assertEqual(dbinterface.files.count(), num_files + 5)
+
+        with self.assertRaises(error.ParamError):
+            dbinterface.apply_retention(exp_id, {'keep_first': 1})
+
+    def test_collect_garbage(self):
+        doc = {'exp_id': 'test_collect_garbage', 'tensor': torch.Tensor([1, 2])}
+        self.dbinterface.save(doc, multithreaded=False)
+        orphan_id = self.dbinterface.filesystem.put(b'orphan')
+        self.assertEqual(self.dbinterface.collect_garbage(), 0)
+        self.assertEqual(self.dbinterface.collect_garbage(grace_seconds=-60), 1)
+        self.assertFalse(self.dbinterface.filesystem.exists(orphan_id))
+        r = self.dbinterface.load({'exp_id': 'test_collect_garbage'})
+        self.assertTrue(torch.equal(doc['tensor'], r[0]['tensor']))
+        self.assertNotIn(database.TENSOR_IDS_KEY, r[0])
+
+        # Records written before TENSOR_IDS_KEY existed are scanned.
+        self.dbinterface.collection.update_many({'exp_id': 'test_collect_garbage'},
+                                                {'$unset': {database.TENSOR_IDS_KEY: ''}})
+        self.assertEqual(self.dbinterface.collect_garbage(grace_seconds=-60), 0)
+        r = self.dbinterface.load({'exp_id': 'test_collect_garbage'})
+        self.assertTrue(torch.equal(doc['tensor'], r[0]['tensor']))
+
+    def test_ensure_indexes(self):
+        indexes = self.dbinterface.collection.index_information()
+        self.assertIn('exp_id_checkpoints', indexes)
+        self.assertIn('exp_id_1_step_1', indexes)
+        # Creating them again is harmless.
+        self.dbinterface.ensure_indexes()
+        self.assertEqual(self.dbinterface.collection.index_information(), indexes)
+
+    def test_ensure_indexes_once(self):
+        client = self.dbinterface.client
+        self.assertFalse(database.CLIENTS.needs_indexes(
+            client, self.database_name, self.collection_name))
+        self.assertFalse(database.CLIENTS.needs_indexes(
+            client, self.database_name, 'fs.files'))
+        registry = database.MongoClientRegistry()
+        client = registry.acquire(self.host, self.port)
+        self.assertTrue(registry.needs_indexes(client, self.database_name, 'testcol'))
+        registry.mark_indexed(client, self.database_name, 'testcol')
+        self.assertFalse(registry.needs_indexes(client, self.database_name, 'testcol'))
+        self.assertTrue(registry.needs_indexes(client, self.database_name, 'othercol'))
+        registry.release(client)
+        client = registry.acquire(self.host, self.port)
+        self.assertTrue(registry.needs_indexes(client, self.database_name, 'testcol'))
+        registry.release(client)
+
+    def test_explain_unsupported(self):
+        class Collection(object):
+            name = 'unexplainable'
+
+            def find(self, query, sort=None):
+                return object()
+
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              explain_queries=True)
+        dbinterface._explain(Collection(), {'exp_id': 'test_explain_unsupported'})
+        self.assertEqual(dbinterface.query_plans(),
+                         {'unexplainable {"exp_id": "str"} sort []': None})
+        dbinterface.close()
+
+    def test_explain_queries(self):
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              explain_queries=True)
+        dbinterface.exists({'exp_id': 'test_explain_queries'})
+        dbinterface.exists({'exp_id': 'test_explain_queries_2'})
+        self.assertEqual(list(dbinterface.query_plans().keys()),
+                         ['{} {{"exp_id": "str"}} sort []'.format(self.collection_name)])
+
+        explain = {'queryPlanner': {'winningPlan': {
+            'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'exp_id_1'}}},
+            'executionStats': {'totalDocsExamined': 3, 'nReturned': 3}}
+        plan = database.MongoInterface._summarize_plan(explain)
+        self.assertEqual(plan['stages'], ['FETCH', 'IXSCAN'])
+        self.assertEqual(plan['indexes'], ['exp_id_1'])
+        self.assertFalse(plan['collscan'])
+        self.assertEqual((plan['docs_examined'], plan['returned']), (3, 3))
+        explain = {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}
+        self.assertTrue(database.MongoInterface._summarize_plan(explain)['collscan'])
+
+    def test_shared_client(self):
+        key = (self.host, self.port, '{}')
+        references = database.CLIENTS.stats()[key]
+        first = database.MongoInterface(self.database_name, self.collection_name,
+                                        self.host, self.port)
+        second = database.MongoInterface(self.database_name, 'testcol_shared_client',
+                                         self.host, self.port)
+        self.assertIs(first.client, self.dbinterface.client)
+        self.assertIs(first.client, second.client)
+        self.assertIs(first.filesystem, second.filesystem)
+        self.assertEqual(database.CLIENTS.stats()[key], references + 2)
+        first.close()
+        first.close()
+        self.assertEqual(database.CLIENTS.stats()[key], references + 1)
+        self.assertEqual(second.count({'exp_id': 'test_shared_client'}), 0)
+        second.close()
+        self.assertEqual(database.CLIENTS.stats()[key], references)
+
+    def test_client_options_unhashable(self):
+        registry = database.MongoClientRegistry()
+        first = registry.acquire(self.host, self.port, event_listeners=[])
+        second = registry.acquire(self.host, self.port, event_listeners=[])
+        self.assertIs(first, second)
+        registry.release(first)
+        registry.release(second)
+        self.assertEqual(registry.stats(), {})
+
+    def test_close(self):
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              retention={'keep_last': 1})
+        dbinterface.save({'exp_id': 'test_close', 'state': {'t': torch.zeros(2)}})
+        dbinterface.load({'exp_id': 'test_close'})
+        self.assertIsNotNone(dbinterface._retention_pool)
+        self.assertIn(dbinterface._exit_flush,
+                      [entry[0] for entry in atexit._exithandlers])
+        dbinterface.close()
+        self.assertIsNone(dbinterface._reader_pool)
+        self.assertIsNone(dbinterface._retention_pool)
+        self.assertNotIn(dbinterface._exit_flush,
+                         [entry[0] for entry in atexit._exithandlers])
+
+    def test_save_journaled(self):
+        journal_dir = 'ptutils_test_journal'
+        self.addCleanup(shutil.rmtree, journal_dir, True)
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              journal_dir=journal_dir)
+        self.assertEqual(dbinterface.to_params()['journal_dir'], journal_dir)
+        exp_id = 'test_save_journaled'
+        weight = torch.randn(4, 4)
+        object_ids = dbinterface.save({'exp_id': exp_id, 'step': 1,
+                                       'state': {'weight': weight}})
+        self.assertIsInstance(object_ids[0], ObjectId)
+        self.assertTrue(dbinterface.replay_journal(timeout=5))
+        loaded = dbinterface.load({'exp_id': exp_id})
+        self.assertEqual(loaded[0]['_id'], object_ids[0])
+        self.assertTrue(torch.equal(loaded[0]['state']['weight'], weight))
+        segments = [name for _, _, names in os.walk(journal_dir)
+                    for name in names if name.endswith('.journal')]
+        self.assertEqual(segments, [])
+
+    def test_save_metrics(self):
+        dbinterface = database.MongoInterface(self.database_name,
+                                              self.collection_name,
+                                              self.host,
+                                              self.port,
+                                              metric_buffer_size=3,
+                                              metric_flush_interval=3600,
+                                              metric_bucket_size=4)
+        exp_id = 'test_save_metrics'
+        for step in range(4):
+            dbinterface.save_metrics({'exp_id': exp_id, 'step': step,
+                                      'loss': 1.0 / (step + 1)})
+        self.assertEqual(dbinterface.metrics.find({'exp_id': exp_id}).count(), 1)
+        for step in range(4, 10):
+            dbinterface.save_metrics({'exp_id': exp_id, 'step': step,
+                                      'loss': 1.0 / (step + 1), 'accuracy': step})
+        dbinterface.sync_with_host()
+        self.assertEqual(self.dbinterface.collection.find({'exp_id': exp_id}).count(), 0)
+        for bucket in dbinterface.metrics.find({'exp_id': exp_id}):
+            self.assertLessEqual(bucket['count'], 4)
+            self.assertEqual(len(bucket['steps']), bucket['count'])
+
+        metrics = dbinterface.load_metrics(exp_id)
+        self.assertItemsEqual(metrics.keys(), ['loss', 'accuracy'])
+        steps, values = metrics['loss']
+        self.assertEqual(steps.tolist(), list(range(10)))
+        self.assertTrue(np.allclose(values, 1.0 / (steps + 1)))
+
+        steps, values = dbinterface.load_metrics(exp_id, 'accuracy', (5, 8))['accuracy']
+        self.assertEqual(steps.tolist(), [5, 6, 7])
+        self.assertEqual(values.tolist(), [5.0, 6.0, 7.0])
+
+        with self.assertRaises(error.ParamError):
+            dbinterface.save_metrics({'exp_id': exp_id, 'step': 10, 'loss': 'nan?'})
+
+
+class TestFileSystemInterface(unittest.TestCase):
+
+    directory = 'ptutils_test_filesystem'
+
+    def setUp(self):
+        self.dbinterface = database.FileSystemInterface(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def test_from_params(self):
+        params = self.dbinterface.to_params()
+        dbinterface = base.Base.from_params(params)
+        self.assertIsInstance(dbinterface, database.FileSystemInterface)
+        self.assertEqual(dbinterface.index_path, self.dbinterface.index_path)
+
+    def test_load_state(self):
+        b = base.Base()
+        b.linear = torch.nn.Linear(3, 2)
+        state = b.to_state()
+        self.dbinterface.save({'exp_id': 'test_load_state', 'step': 1,
+                               'state': state, 'params': b.to_params()})
+        r = self.dbinterface.load({'exp_id': 'test_load_state'})[0]
+        self.assertEqual(r['params']['func'], base.Base)
+        for name in state:
+            self.assertTrue(torch.equal(state[name], r['state'][name]))
+        path = self.dbinterface.load({'exp_id': 'test_load_state'},
+                                     get_tensors=False)[0]['state']['linear.weight']
+        self.assertTrue(path.endswith('.npy'))
+        self.assertIsInstance(np.load(path, mmap_mode='c'), np.memmap)
+
+    def test_load_query(self):
+        exp_id = 'test_load_query'
+        self.dbinterface.save([{'exp_id': exp_id, 'step': 1, 'state': {'t': torch.zeros(1)}},
+                               {'exp_id': exp_id, 'step': 2, 'loss': 0.5}])
+        self.assertEqual(self.dbinterface.load({'exp_id': exp_id})[0]['step'], 2)
+        r = self.dbinterface.load({'exp_id': exp_id, 'state': {'$exists': True}})
+        self.assertEqual(r[0]['step'], 1)
+        r = self.dbinterface.load({'exp_id': exp_id, 'step': {'$gte': 1}}, return_all=True)
+        self.assertEqual([doc['step'] for doc in r], [2, 1])
+        self.assertTrue(self.dbinterface.exists({'exp_id': exp_id}))
+        self.assertFalse(self.dbinterface.exists({'exp_id': exp_id + '_missing'}))
+
+        # Records appended by another interface are picked up.
+        other = database.FileSystemInterface(self.directory)
+        other.save({'exp_id': exp_id, 'step': 3})
+        self.assertEqual(self.dbinterface.load({'exp_id': exp_id})[0]['step'], 3)
+
+    def test_delete(self):
+        object_id = self.dbinterface.save({'exp_id': 'test_delete',
+                                           'tensor': torch.ones(2)})[0]
+        self.dbinterface.delete(object_id)
+        self.assertEqual(self.dbinterface.load({'exp_id': 'test_delete'}), [])
+        self.assertEqual(os.listdir(self.dbinterface.tensor_directory), [])
+        reopened = database.FileSystemInterface(self.directory)
+        self.assertFalse(reopened.exists({'exp_id': 'test_delete'}))
+
+    def test_overwrite(self):
+        object_id = self.dbinterface.save({'exp_id': 'test_overwrite',
+                                           'state': {'a': torch.ones(2), 'b': torch.ones(3)}})[0]
+        self.dbinterface.save({'_id': object_id, 'exp_id': 'test_overwrite',
+                               'state': {'a': torch.zeros(2)}})
+        r = self.dbinterface.load({'exp_id': 'test_overwrite'}, return_all=True)
+        self.assertEqual(len(r), 1)
+        self.assertTrue(torch.equal(r[0]['state']['a'], torch.zeros(2)))
+        self.assertEqual(len(os.listdir(self.dbinterface.tensor_directory)), 1)
+
+    def test_load_projection(self):
+        self.dbinterface.save({'exp_id': 'test_load_projection', 'step': 1,
+                               'state': {'t': torch.ones(2)}})
+        r = self.dbinterface.load({'exp_id': 'test_load_projection'}, projection=['step'])[0]
+        self.assertEqual(sorted(r.keys()), ['_id', 'step'])
+        r = self.dbinterface.load({'exp_id': 'test_load_projection'},
+                                  projection={'state': False}, lazy=True)[0]
+        self.assertNotIn('state', r)
+        with self.assertRaises(TypeError):
+            self.dbinterface.load({'exp_id': 'test_load_projection'}, batch_size=10)
+
+
+class TestSQLiteInterface(unittest.TestCase):
+
+    database_path = 'ptutils_test.sqlite'
+
+    def setUp(self):
+        self.dbinterface = database.SQLiteInterface(self.database_path)
+        self.addCleanup(self.remove_files)
+
+    def remove_files(self):
+        self.dbinterface.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.database_path + suffix):
+                os.remove(self.database_path + suffix)
+        shutil.rmtree(self.dbinterface.tensor_directory, True)
+
+    def test_from_params(self):
+        dbinterface = base.Base.from_params(self.dbinterface.to_params())
+        self.addCleanup(dbinterface.close)
+        self.assertIsInstance(dbinterface, database.SQLiteInterface)
+        self.assertEqual(dbinterface.tensor_directory, self.dbinterface.tensor_directory)
+        journal_mode = dbinterface.connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(journal_mode, 'wal')
+
+    def test_load_state(self):
+        b = base.Base()
+        b.linear = torch.nn.Linear(3, 2)
+        state = b.to_state()
+        exp_id = 'test_load_state'
+        self.dbinterface.save({'exp_id': exp_id, 'step': 1, 'state': state,
+                               'params': b.to_params()})
+        self.dbinterface.save({'exp_id': exp_id, 'step': 2, 'loss': 0.5})
+        self.assertEqual(self.dbinterface.load({'exp_id': exp_id})[0]['step'], 2)
+        r = self.dbinterface.load({'exp_id': exp_id, 'state': {'$exists': True}})[0]
+        self.assertEqual(r['params']['func'], base.Base)
+        for name in state:
+            self.assertTrue(torch.equal(state[name], r['state'][name]))
+        r = self.dbinterface.load({'exp_id': exp_id, 'state': {'$exists': False}},
+                                  return_all=True)
+        self.assertEqual([doc['step'] for doc in r], [2])
+        r = self.dbinterface.load({'exp_id': exp_id, 'loss': {'$lt': 1}})
+        self.assertEqual(r[0]['step'], 2)
+        self.assertTrue(self.dbinterface.exists({'exp_id': exp_id}))
+        self.assertFalse(self.dbinterface.exists({'exp_id': exp_id + '_missing'}))
+
+    def test_delete(self):
+        object_id = self.dbinterface.save({'exp_id': 'test_delete',
+                                           'tensor': torch.ones(2)})[0]
+        self.dbinterface.delete(object_id)
+        self.assertEqual(self.dbinterface.load({'exp_id': 'test_delete'}), [])
+        self.assertEqual(os.listdir(self.dbinterface.tensor_directory), [])
+
+    def test_overwrite(self):
+        object_id = self.dbinterface.save({'exp_id': 'test_overwrite',
+                                           'state': {'a': torch.ones(2), 'b': torch.ones(3)}})[0]
+        self.dbinterface.save({'_id': object_id, 'exp_id': 'test_overwrite',
+                               'state': {'a': torch.zeros(2)}})
+        r = self.dbinterface.load({'exp_id': 'test_overwrite'}, return_all=True)
+        self.assertEqual(len(r), 1)
+        self.assertTrue(torch.equal(r[0]['state']['a'], torch.zeros(2)))
+        self.assertEqual(len(os.listdir(self.dbinterface.tensor_directory)), 1)
+        r = self.dbinterface.load({'exp_id': 'test_overwrite'}, projection=['exp_id'])
+        self.assertEqual(sorted(r[0].keys()), ['_id', 'exp_id'])
+
+    def test_save_metrics(self):
+        for step in range(10):
+            self.dbinterface.save_metrics({'exp_id': 'test_save_metrics', 'step': step,
+                                           'loss': 1.0 / (step + 1)})
+        steps, values = self.dbinterface.load_metrics('test_save_metrics', 'loss',
+                                                      (2, 5))['loss']
+        self.assertEqual(steps.tolist(), [2, 3, 4])
+        self.assertTrue(np.allclose(values, 1.0 / (steps + 1)))
+
+    def test_close(self):
+        self.dbinterface.save_metrics({'exp_id': 'test_close', 'step': 1, 'loss': 0.5})
+        self.dbinterface.close()
+        self.dbinterface.close()
+        self.assertNotIn(self.dbinterface._exit_flush,
+                         [entry[0] for entry in atexit._exithandlers])
+        reopened = database.SQLiteInterface(self.database_path)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.load_metrics('test_close')['loss'][0].tolist(), [1])
+
+
+class TestInMemoryInterface(unittest.TestCase):
+
+    def setUp(self):
+        self.dbinterface = database.InMemoryInterface(collection_name=self.id())
+        self.addCleanup(self.dbinterface.drop)
+
+    def test_from_params(self):
+        self.dbinterface.save({'exp_id': 'test_from_params'})
+        dbinterface = base.Base.from_params(self.dbinterface.to_params())
+        self.assertIsInstance(dbinterface, database.InMemoryInterface)
+        self.assertTrue(dbinterface.exists({'exp_id': 'test_from_params'}))
+
+    def test_load(self):
+        exp_id = 'test_load'
+        tensor = torch.zeros(2)
+        object_ids = self.dbinterface.save([{'exp_id': exp_id, 'step': 1, 'state': {'t': tensor}},
+                                            {'exp_id': exp_id, 'step': 2, 'loss': 0.5}])
+        self.assertEqual(self.dbinterface.load({'exp_id': exp_id})[0]['step'], 2)
+        r = self.dbinterface.load({'exp_id': exp_id, 'state': {'$exists': True}})[0]
+        self.assertEqual(r['state']['t'].data_ptr(), tensor.data_ptr())
+        r = self.dbinterface.load({'exp_id': exp_id}, return_all=True, projection=['step'])
+        self.assertEqual(r, [{'_id': object_ids[1], 'step': 2},
+                             {'_id': object_ids[0], 'step': 1}])
+        self.assertEqual(self.dbinterface.count({'exp_id': exp_id}), 2)
+        self.assertEqual(self.dbinterface.latest(exp_id, 'loss'), 0.5)
+        r = self.dbinterface.load_from_ids([str(object_ids[0]), ObjectId()])
+        self.assertEqual((r[0]['step'], r[1]), (1, None))
+
+        self.dbinterface.delete(object_ids[1])
+        self.assertEqual([doc['step'] for doc in self.dbinterface.iter_load({'exp_id': exp_id})],
+                         [1])
+
+    def test_drop(self):
+        self.dbinterface.save({'exp_id': 'test_drop', 'step': 1})
+        self.dbinterface.save_metrics({'exp_id': 'test_drop', 'step': 1, 'loss': 0.5})
+        other = database.InMemoryInterface(collection_name=self.id())
+        self.dbinterface.drop()
+        self.assertFalse(other.exists({'exp_id': 'test_drop'}))
+        self.assertEqual(other.load_metrics('test_drop'), {})
+        self.assertNotIn(('ptutils', self.id()), database._IN_MEMORY_COLLECTIONS)
+        database.InMemoryInterface(collection_name='test_clear').save({'exp_id': 'test_clear'})
+        database.InMemoryInterface.clear()
+        self.assertEqual(database._IN_MEMORY_COLLECTIONS, {})
+
+    def test_save_snapshot(self):
+        buffers = snapshot.SnapshotBuffers(num_buffers=1)
+        state = buffers.take({'weight': torch.ones(2)})
+        self.dbinterface.save_checkpoint({'exp_id': 'test_save_snapshot', 'state': state})
+        self.assertTrue(state.released)
+        stored = self.dbinterface.load({'exp_id': 'test_save_snapshot'})[0]['state']
+        self.assertIs(type(stored), dict)
+        self.assertTrue(torch.equal(stored['weight'], torch.ones(2)))
+
+    def test_copy_tensors(self):
+        dbinterface = database.InMemoryInterface(collection_name=self.id(), copy_tensors=True)
+        tensor = torch.zeros(2)
+        dbinterface.save({'exp_id': 'test_copy_tensors', 'tensor': tensor})
+        tensor.add_(1)
+        r = dbinterface.load({'exp_id': 'test_copy_tensors'})[0]
+        self.assertTrue(torch.equal(r['tensor'], torch.zeros(2)))
+
+    def test_load_run(self):
+        b = base.Base()
+        b.linear = torch.nn.Linear(2, 2)
+        self.dbinterface.save({'exp_id': 'test_load_run', 'step': 1,
+                               'state': b.to_state(), 'params': b.to_params()})
+        self.dbinterface.save({'exp_id': 'test_load_run', 'step': 2, 'loss': 0.5})
+        run = runner.Runner(exp_id='test_load_run',
+                            load_params={'dbinterface': self.dbinterface,
+                                         'query': {'exp_id': 'test_load_run'}})
+        self.assertEqual(run.load_run()['step'], 1)
+
+    def test_runner_init_restore(self):
+        class Net(torch.nn.Module):
+            def __init__(self, **kwargs):
+                super(Net, self).__init__()
+                self.linear = torch.nn.Linear(2, 2)
+
+        exp_id = 'test_runner_init_restore'
+        dbinterface_params = {'func': database.InMemoryInterface,
+                              'collection_name': self.id()}
+        saved = runner.Runner(exp_id=exp_id, model=Net(), global_step=3,
+                              dbinterface=base.Base.from_params(dict(dbinterface_params)),
+                              load_params={'restore': False, 'query': {'exp_id': exp_id}})
+        saved.dbinterface.save({'exp_id': exp_id, 'step': 3,
+                                'state': saved.to_state(), 'params': saved.to_params()})
+
+        params = {'func': runner.Runner,
+                  'exp_id': exp_id,
+                  'model': {'func': Net},
+                  'dbinterface': dict(dbinterface_params),
+                  'load_params': {'restore': True,
+                                  'query': {'exp_id': exp_id},
+                                  'dbinterface': dict(dbinterface_params)}}
+        restored = runner.Runner.init(params)
+        self.assertIsInstance(restored.dbinterface, database.InMemoryInterface)
+        self.assertEqual(restored.global_step, 3)
+        self.assertTrue(torch.equal(restored.model.linear.weight, saved.model.linear.weight))
+        self.assertTrue(torch.equal(restored.model.linear.bias, saved.model.linear.bias))
+
+    def test_save_metrics(self):
+        for step in range(5):
+            self.dbinterface.save_metrics({'exp_id': 'test_save_metrics', 'step': step,
+                                           'loss': float(step)})
+        steps, values = self.dbinterface.load_metrics('test_save_metrics',
+                                                      step_range=(3, None))['loss']
+        self.assertEqual(steps.tolist(), [3, 4])
+        self.assertEqual(values.tolist(), [3.0, 4.0])
+
+
+class TestCheckpointWriterPool(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.written = []
+
+    def write(self, record):
+        self.release.wait()
+        self.written.append(record['step'])
+
+    def make_pool(self, policy):
+        pool = database.CheckpointWriterPool(self.write, num_threads=1,
+                                             max_queued=1, policy=policy)
+        pool.submit({'step': 0, 'state': {}})
+        while pool.stats()['in_flight'] == 0:
+            time.sleep(0.001)
+        return pool
+
+    def test_drop_metrics(self):
+        pool = self.make_pool('drop_metrics')
+        self.assertTrue(pool.submit({'step': 1}))
+        self.assertFalse(pool.submit({'step': 2}))
+        self.release.set()
+        pool.join()
+        self.assertEqual(self.written, [0, 1])
+        self.assertEqual(pool.stats()['dropped'], 1)
+
+    def test_coalesce(self):
+        pool = self.make_pool('coalesce')
+        pool.submit({'step': 1, 'state': {}})
+        pool.submit({'step': 2, 'state': {}})
+        self.release.set()
+        pool.join()
+        self.assertEqual(self.written, [0, 2])
+        self.assertEqual(pool.stats()['coalesced'], 1)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            database.CheckpointWriterPool(self.write, policy='unknown')
+
+    def test_close(self):
+        pool = self.make_pool('block')
+        pool.submit({'step': 1})
+        self.release.set()
+        pool.close()
+        pool.close()
+        self.assertEqual(self.written, [0, 1])
+        self.assertFalse(any(thread.is_alive() for thread in pool._threads))
+        with self.assertRaises(ValueError):
+            pool.submit({'step': 2})
+
+
+class TestCheckpointJournal(unittest.TestCase):
+
+    directory = 'ptutils_test_checkpoint_journal'
+
+    def setUp(self):
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.addCleanup(shutil.rmtree, self.directory + '_copy', True)
+
+    def unreachable(self, record):
+        raise pymongo.errors.AutoReconnect('unreachable')
+
+    def test_replay_after_crash(self):
+        journal = database.CheckpointJournal(self.directory, self.unreachable,
+                                             segment_bytes=1, retry_seconds=3600)
+        for step in range(3):
+            journal.append({'step': step, 'state': {'weight': torch.ones(2) * step}})
+        self.assertFalse(journal.join(timeout=0.01))
+        self.assertEqual(journal.pending(), 3)
+        with self.assertRaises(error.ParamError):
+            database.CheckpointJournal(self.directory, self.unreachable)
+
+        # Recover a copy of the journal whose last append was cut short.
+        copy = self.directory + '_copy'
+        shutil.copytree(self.directory, copy)
+        last = sorted(name for name in os.listdir(copy) if name.endswith('.journal'))[-1]
+        with open(os.path.join(copy, last), 'ab') as f:
+            f.write(database.CheckpointJournal.HEADER.pack(100, 3, 0) + b'torn')
+        written = []
+        recovered = database.CheckpointJournal(copy, written.append)
+        self.assertTrue(recovered.join(timeout=5))
+        self.assertEqual([record['step'] for record in written], [0, 1, 2])
+        self.assertTrue(torch.equal(written[2]['state']['weight'], torch.ones(2) * 2))
+        self.assertEqual(recovered.stats()['segments'], 0)
+        self.assertEqual([name for name in os.listdir(copy)
+                          if name.endswith('.journal')], [])
+
+    def test_quarantine_unreadable_record(self):
+        journal = database.CheckpointJournal(self.directory, self.unreachable,
+                                             retry_seconds=3600)
+        journal.append({'step': 0})
+        self.assertFalse(journal.join(timeout=0.01))
+        # A frame with a valid checksum whose payload is not a pickle.
+        payload = b'not a pickle'
+        copy = self.directory + '_copy'
+        shutil.copytree(self.directory, copy)
+        segment = [name for name in os.listdir(copy) if name.endswith('.journal')][0]
+        with open(os.path.join(copy, segment), 'wb') as f:
+            f.write(database.CheckpointJournal.HEADER.pack(
+                len(payload), 0, zlib.crc32(payload) & 0xffffffff) + payload)
+        written = []
+        recovered = database.CheckpointJournal(copy, written.append)
+        recovered.append({'step': 1})
+        self.assertTrue(recovered.join(timeout=5))
+        self.assertEqual(written, [{'step': 1}])
+        self.assertEqual(recovered.stats()['failed'], 1)
+        with open(os.path.join(copy, '{:020d}.quarantine'.format(0)), 'rb') as f:
+            self.assertEqual(f.read(), payload)
+
+    def test_open_journal(self):
+        target = ('localhost', 27017, 'ptutils_test', 'test_open_journal')
+        journal = database._open_journal(self.directory, target, self.unreachable,
+                                         retry_seconds=3600)
+        self.addCleanup(database._JOURNALS.pop,
+                        (os.path.realpath(self.directory), target))
+        self.assertIs(database._open_journal(self.directory, target, self.unreachable),
+                      journal)
+        with self.assertRaises(error.ParamError):
+            database._open_journal(self.directory, target[:3] + ('other',),
+                                   self.unreachable)
+
+
+class TestSnapshotBuffers(unittest.TestCase):
+
+    def test_take(self):
+        buffers = snapshot.SnapshotBuffers(num_buffers=2)
+        state = {'weight': torch.randn(3, 3), 'mean': np.zeros(3), 'step': 1}
+        first = buffers.take(state)
+        state['weight'].add_(1)
+        state['mean'] += 1
+        self.assertFalse(torch.equal(first['weight'], state['weight']))
+        self.assertEqual(first['mean'].sum(), 0)
+        self.assertEqual(first['step'], 1)
+
+        second = buffers.take(state)
+        self.assertTrue(torch.equal(second['weight'], state['weight']))
+        self.assertNotEqual(first['weight'].data_ptr(), second['weight'].data_ptr())
+        unbuffered = buffers.take(state, block=False)
+        self.assertEqual(buffers.stats()['unbuffered'], 1)
+        unbuffered.release()
+
+        # Buffers are reused once released.
+        first.release()
+        first.release()
+        third = buffers.take(state)
+        self.assertEqual(third['weight'].data_ptr(), first['weight'].data_ptr())
+        self.assertIs(third['mean'], first['mean'])
+        self.assertEqual(buffers.stats()['free'], 0)
+
+    def test_take_waits_for_release(self):
+        buffers = snapshot.SnapshotBuffers(num_buffers=1)
+        held = buffers.take({'weight': torch.zeros(2)})
+        timer = threading.Timer(0.01, held.release)
+        timer.start()
+        with buffers.take({'weight': torch.ones(2)}) as taken:
+            self.assertTrue(torch.equal(taken['weight'], torch.ones(2)))
+        timer.join()
+        self.assertEqual(buffers.stats()['waits'], 1)
+        self.assertEqual(buffers.stats()['free'], 1)
+
+
+class TestBlobCache(unittest.TestCase):
+
+    cache_dir = 'ptutils_test_blob_cache'
+
+    def setUp(self):
+        self.cache = database.BlobCache(self.cache_dir, max_bytes=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', bytearray(b'1234'))
+        self.assertEqual(self.cache.get('a')[:], b'1234')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', b'1234')
+        os.utime(os.path.join(self.cache_dir, 'a'), (0, 0))
+        self.cache.put('b', b'1234')
+        self.cache.put('c', b'1234')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+        self.assertEqual(self.cache._total_bytes, 8)
+
+    def test_tracks_size(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('a', b'12')
+        self.assertEqual(self.cache._total_bytes, 2)
+        self.assertEqual(database.BlobCache(self.cache_dir)._total_bytes, 2)
+
 
 class TestModel(Test):
 
@@ -704,6 +1779,21 @@ class TestModel(Test):
         pass
 
 
+# Journaled records are pickled, so their params may only refer to
+# module-level classes.
+class JournaledNet(torch.nn.Module):
+
+    def __init__(self, **kwargs):
+        super(JournaledNet, self).__init__()
+        self.linear = torch.nn.Linear(2, 2)
+
+
+class ConstantRunner(runner.Runner):
+
+    def predict(self, prev_output=None):
+        return {'loss': 1.0}
+
+
 class TestRunner(Test):
 
     @classmethod
@@ -731,6 +1821,131 @@ class TestRunner(Test):
         runner_obj = self.test_class.from_params(params)
         self.assertDictContainsSubset(params, runner_obj.to_params())
 
+    def test_train_checkpoints_snapshots(self):
+        class CountingRunner(runner.Runner):
+            def step(self, prev_output):
+                self.model.weight.data.fill_(self.global_step)
+                self.global_step += 1
+                return {'loss': torch.ones(1)}
+
+        dbinterface = database.InMemoryInterface(collection_name=self.id())
+        runner_obj = CountingRunner(exp_id='test_train_checkpoints_snapshots',
+                                    model=torch.nn.Linear(4, 4),
+                                    dbinterface=dbinterface,
+                                    train_params={'num_steps': 6},
+                                    save_params={'metric_freq': 2},
+                                    global_step=0)
+        runner_obj.validation_params = None
+        self.assertNotIn('_snapshots', runner_obj.to_params())
+        runner_obj.train()
+
+        records = dbinterface.load({'exp_id': 'test_train_checkpoints_snapshots',
+                                    'state': {'$exists': True}}, return_all=True)
+        self.assertEqual(sorted(r['step'] for r in records), [2, 4, 6])
+        for record in records:
+            self.assertTrue(torch.equal(record['state']['model.weight'],
+                                        torch.full((4, 4), record['step'] - 1)))
+        self.assertEqual(runner_obj._snapshots.stats()['free'], 2)
+
+    def test_train_does_not_wait_for_snapshots(self):
+        class CountingRunner(runner.Runner):
+            def step(self, prev_output):
+                self.global_step += 1
+                return {'loss': torch.ones(1)}
+
+        # A writer that has not finished any checkpoint yet.
+        held = []
+        dbinterface = database.InMemoryInterface(collection_name=self.id())
+        dbinterface.save_checkpoint = held.append
+        runner_obj = CountingRunner(exp_id='test_train_does_not_wait_for_snapshots',
+                                    model=torch.nn.Linear(2, 2),
+                                    dbinterface=dbinterface,
+                                    train_params={'num_steps': 4},
+                                    save_params={'metric_freq': 1},
+                                    global_step=0)
+        runner_obj.validation_params = None
+        runner_obj.train()
+        self.assertEqual(len(held), 4)
+        stats = runner_obj._snapshots.stats()
+        self.assertEqual((stats['waits'], stats['snapshots'], stats['unbuffered']), (0, 2, 2))
+        for record in held:
+            record['state'].release()
+
+    def test_journal_unreachable_does_not_hang(self):
+        exp_id = 'test_journal_unreachable_does_not_hang'
+        journal_dir = 'ptutils_test_runner_journal'
+        dbinterface_params = {'func': database.MongoInterface,
+                              'database_name': self.database_name,
+                              'collection_name': exp_id,
+                              'host': self.host,
+                              'port': self.port,
+                              'journal_dir': journal_dir,
+                              'journal_timeout': 0.05}
+        dbinterface = base.Base.from_params(dict(dbinterface_params))
+        journal = dbinterface._journal
+        write = journal.write
+
+        def cleanup():
+            journal.write = write
+            self.assertTrue(journal.join(timeout=5))
+            database._JOURNALS.pop((os.path.realpath(journal.directory),
+                                    (self.host, self.port, self.database_name, exp_id)))
+            shutil.rmtree(journal_dir, True)
+
+        self.addCleanup(cleanup)
+
+        def unreachable(record):
+            raise pymongo.errors.AutoReconnect('unreachable')
+
+        journal.write = unreachable
+        journal.retry_seconds = 0.01
+
+        # A checkpoint written before the database became unreachable.
+        saved = runner.Runner(exp_id=exp_id, model=JournaledNet(), global_step=1,
+                              load_params={'restore': False, 'query': {'exp_id': exp_id}})
+        database.MongoInterface(self.database_name, exp_id, self.host, self.port).save(
+            {'exp_id': exp_id, 'step': 1, 'state': saved.to_state(),
+             'params': saved.to_params()}, multithreaded=False)
+
+        runner_obj = ConstantRunner(exp_id=exp_id, model=JournaledNet(), dbinterface=dbinterface,
+                                    global_step=1, load_params={})
+        runner_obj.validation_params = {'num_steps': 1}
+        start = time.time()
+        runner_obj.test()
+        self.assertGreater(journal.pending(), 0)
+
+        params = {'func': runner.Runner,
+                  'exp_id': exp_id,
+                  'model': {'func': JournaledNet},
+                  'dbinterface': dict(dbinterface_params),
+                  'load_params': {'restore': True,
+                                  'query': {'exp_id': exp_id},
+                                  'dbinterface': dict(dbinterface_params)}}
+        restored = runner.Runner.init(params)
+        self.assertEqual(restored.global_step, 1)
+        self.assertLess(time.time() - start, 5)
+
+    def test_train_checkpoint_failure_releases_snapshot(self):
+        class CountingRunner(runner.Runner):
+            def step(self, prev_output):
+                self.global_step += 1
+                return {'loss': torch.ones(1)}
+
+        def fail(record):
+            raise IOError('disk full')
+
+        dbinterface = database.InMemoryInterface(collection_name=self.id())
+        dbinterface.save_checkpoint = fail
+        runner_obj = CountingRunner(exp_id='test_train_checkpoint_failure_releases_snapshot',
+                                    model=torch.nn.Linear(2, 2),
+                                    dbinterface=dbinterface,
+                                    train_params={'num_steps': 2},
+                                    save_params={'metric_freq': 1},
+                                    global_step=0)
+        with self.assertRaises(IOError):
+            runner_obj.train()
+        self.assertEqual(runner_obj._snapshots.stats()['free'], 2)
+
     @unittest.skip('skipping...')
     def test_training_from_objects(self):
         runner = self.test_class(exp_id='test_exp_id')